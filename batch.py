@@ -0,0 +1,80 @@
+import asyncio
+import concurrent.futures
+import os
+from simulator import Simulator
+
+# circuits of the batch, set once in each worker process by init_worker
+circuits = []
+
+def init_worker(table):
+    global circuits
+    circuits = table
+
+def run_chunk(chunk, options):
+    """Run a chunk of (index, num_qudits, qudit, circuit number, init_state) jobs in a\n
+    worker, returning (index, final state as a dict) pairs, or (index, exception)\n
+    Each circuit is only parsed and compiled the first time the worker runs it
+    """
+    results = []
+    for index,num_qudits,qudit,circuit,init_state in chunk:
+        try:
+            sim = Simulator(num_qudits, qudit, circuits[circuit], init_state, **options)
+            sim.run()
+            results.append((index, dict(sim.state.items())))
+        except Exception as e:
+            results.append((index, e)) # raised again in the main process
+    return results
+
+def prepare(jobs, chunk_size):
+    """Number the distinct circuits of the jobs and split the jobs into chunks"""
+    table = []
+    numbers = {} # circuit contents --> number in table
+    chunks = [[]]
+    for index,(num_qudits, qudit, circuit, init_state) in enumerate(jobs):
+        circuit = tuple(circuit)
+        if circuit not in numbers:
+            numbers[circuit] = len(table)
+            table.append(circuit)
+        if len(chunks[-1]) == chunk_size:
+            chunks.append([])
+        chunks[-1].append((index, num_qudits, qudit, numbers[circuit], init_state))
+    return table, [chunk for chunk in chunks if chunk]
+
+def start(jobs, processes, chunk_size, options):
+    """Start a process pool on the jobs, returning it and the future of each chunk"""
+    if chunk_size < 1: raise Exception("chunk_size needs to be at least 1")
+    table, chunks = prepare(jobs, chunk_size)
+    # the circuits go to each worker once, when it starts, instead of with every job
+    executor = concurrent.futures.ProcessPoolExecutor(processes or os.cpu_count(),
+                                                      initializer=init_worker, initargs=(table,))
+    return executor, [executor.submit(run_chunk, chunk, options) for chunk in chunks]
+
+def results(chunk_results):
+    for index,state in chunk_results:
+        if isinstance(state, Exception): raise state
+        yield index, state
+
+def run_batch(jobs, processes=None, chunk_size=64, **options):
+    """Run an iterable of (num_qudits, qudit, circuit, init_state) jobs on a pool of\n
+    processes (os.cpu_count() by default), chunk_size jobs per task\n
+    Yields (job index, final state as a {basis_state: amplitude} dict) in the order the\n
+    jobs finish. options are passed on to every Simulator, e.g. backend="dense"
+    """
+    executor, futures = start(jobs, processes, chunk_size, options)
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            yield from results(future.result())
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+async def run_batch_async(jobs, processes=None, chunk_size=64, **options):
+    """Asynchronous version of run_batch: an async iterator of (job index, final state)\n
+    that awaits the workers without blocking the event loop
+    """
+    executor, futures = start(jobs, processes, chunk_size, options)
+    try:
+        for future in asyncio.as_completed([asyncio.wrap_future(f) for f in futures]):
+            for result in results(await future):
+                yield result
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
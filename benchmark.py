@@ -0,0 +1,220 @@
+"""Benchmark the simulator over circuit families, sizes, state densities and backends
+
+Run the benchmarks and save the results:
+    python benchmark.py run --families ghz qft --sizes 4 8 12 --backends sparse dense --out new.json
+Compare two runs, exiting with status 1 if anything got slower or bigger than the threshold:
+    python benchmark.py compare old.json new.json --threshold 1.2
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from simulator import Simulator
+
+def ghz(n):
+    """GHZ state preparation on n qubits"""
+    return ["h-0"] + [f"cx-{i},{i+1}" for i in range(n - 1)]
+
+def controlled_phase(qc, qi, theta):
+    """Controlled phase gate built from phase and cx gates"""
+    return [f"phase-{qc};{theta/2}", f"cx-{qc},{qi}", f"phase-{qi};{-theta/2}",
+            f"cx-{qc},{qi}", f"phase-{qi};{theta/2}"]
+
+def qft(n):
+    """Quantum Fourier transform on n qubits, from h, phase, cx and swap gates"""
+    circuit = []
+    for j in reversed(range(n)):
+        circuit.append(f"h-{j}")
+        for k in reversed(range(j)):
+            circuit += controlled_phase(k, j, math.pi / 2**(j - k))
+    for j in range(n // 2):
+        circuit.append(f"swap-{j},{n-1-j}")
+    return circuit
+
+def random_clifford_rz(n, depth=None, seed=0):
+    """Random circuit of Clifford gates (x, y, z, h, cx, swap) and Rz rotations"""
+    rng = random.Random(seed)
+    circuit = []
+    for _ in range(depth or 5 * n):
+        gate = rng.choice(["x", "y", "z", "h", "cx", "swap", "Rz"])
+        if gate in ("cx", "swap"):
+            qc, qi = rng.sample(range(n), 2)
+            circuit.append(f"{gate}-{qc},{qi}")
+        elif gate == "Rz":
+            circuit.append(f"Rz-{rng.randrange(n)};{rng.uniform(0, 2*math.pi)}")
+        else:
+            circuit.append(f"{gate}-{rng.randrange(n)}")
+    return circuit
+
+def toffoli_adder(n):
+    """Ripple-carry adder of two registers a, b (sum into b) from ccx and cx gates\n
+    Uses n qubits: a and b take a third each, the carries take the rest
+    """
+    bits = max(1, (n - 1) // 3)
+    a = list(range(bits))
+    b = list(range(bits, 2 * bits))
+    c = list(range(2 * bits, 3 * bits + 1))
+    # some input to add
+    circuit = [f"x-{q}" for q in a[::2] + b[1::2]]
+    for i in range(bits):
+        circuit += [f"ccx-{a[i]},{b[i]},{c[i+1]}", f"cx-{a[i]},{b[i]}", f"ccx-{c[i]},{b[i]},{c[i+1]}"]
+    for i in reversed(range(bits)):
+        circuit += [f"cx-{c[i]},{b[i]}"]
+        if i > 0:
+            circuit += [f"ccx-{c[i-1]},{b[i-1]},{c[i]}"]
+    return circuit
+
+def qutrit_cswap(n):
+    """Qutrit circuits like in example.py: h3 on half the qutrits, then cswap3s"""
+    half = max(1, n // 2)
+    circuit = [f"h3-{i}" for i in range(half)]
+    for i in range(n - 2):
+        circuit.append(f"cswap3-{i},{i+1},{n-1-i if n-1-i not in (i, i+1) else (i+2) % n}")
+    return circuit
+
+# family: (qudit, circuit generator, smallest size)
+FAMILIES = {
+    "ghz": (2, ghz, 2),
+    "qft": (2, qft, 2),
+    "clifford_rz": (2, random_clifford_rz, 2),
+    "adder": (2, toffoli_adder, 4),
+    "qutrit": (3, qutrit_cswap, 3),
+}
+
+def superposed(circuit):
+    """Qudits whose first gate in circuit is a Hadamard"""
+    first = {}
+    for gate in circuit:
+        name, _, targets = gate.partition(";")[0].partition("-")
+        for q in map(int, targets.split(",")):
+            first.setdefault(q, name)
+    return {q for q,name in first.items() if name in ("h", "h3")}
+
+def make_circuit(family, n, density):
+    """Circuit of a family on n qudits, after putting a density fraction of the qudits\n
+    the circuit doesn't start with a Hadamard on in superposition, to control how many\n
+    nonzero amplitudes the state has\n
+    Qubits get an Ry with a generic angle rather than h, so that later gates of the\n
+    circuit (or the optimizer) can't undo it. For qutrits h3 is the only choice, which\n
+    is why qudits the circuit already superposes are skipped
+    """
+    qudit, generator, _ = FAMILIES[family]
+    circuit = generator(n)
+    free = [q for q in reversed(range(n)) if q not in superposed(circuit)]
+    prepare = sorted(free[:round(density * len(free))])
+    return [f"Ry-{q};1.0" if qudit == 2 else f"h3-{q}" for q in prepare] + circuit
+
+def run_case(family, n, density, backend, repeat=3):
+    """Time one circuit and record its peak memory and nonzero amplitudes per gate"""
+    qudit = FAMILIES[family][0]
+    circuit = make_circuit(family, n, density)
+    with tempfile.TemporaryDirectory() as tmp:
+        options = {"backend": backend, "validate": "end"}
+        if backend == "memmap":
+            options["memmap_path"] = os.path.join(tmp, "state.bin")
+        times = []
+        for _ in range(repeat):
+            sim = Simulator(n, qudit=qudit, circuit=circuit, init_state={0: 1}, **options)
+            start = time.perf_counter()
+            sim.run()
+            times.append(time.perf_counter() - start)
+        # second pass with a hook for memory and density (tracing slows it down), without
+        # optimizing so that nonzero has one entry per gate of the circuit (after the initial state)
+        sim = Simulator(n, qudit=qudit, circuit=circuit, init_state={0: 1}, **options)
+        ops = sim.compile()
+        nonzero = [len(sim.state)]
+        sim.add_hook(lambda event: nonzero.append(event.nonzero_after))
+        tracemalloc.start()
+        sim.run(optimize=False)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del sim
+    return {
+        "family": family, "qudit": qudit, "num_qudits": n, "density": density, "backend": backend,
+        "gates": len(circuit), "compiled_gates": len(ops), "wall_time": min(times),
+        "peak_memory": peak, "max_nonzero": max(nonzero), "nonzero": nonzero,
+    }
+
+def run(args):
+    results = []
+    for family in args.families:
+        for n in args.sizes:
+            if n < FAMILIES[family][2]:
+                continue
+            for density in args.densities:
+                for backend in args.backends:
+                    result = run_case(family, n, density, backend, args.repeat)
+                    results.append(result)
+                    print(f"{family:12} n={n:<3} density={density:<4} {backend:7} "
+                          f"{result['wall_time']*1e3:10.2f} ms {result['peak_memory']/2**20:9.2f} MiB "
+                          f"max nonzero {result['max_nonzero']}", file=sys.stderr)
+    report = {
+        "meta": {"python": platform.python_version(), "numpy": np.__version__,
+                 "machine": platform.machine(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=1)
+
+def case_key(result):
+    return (result["family"], result["num_qudits"], result["density"], result["backend"])
+
+def compare(old, new, threshold=1.2, min_time=1e-3):
+    """Regressions from results old to results new: (case, metric, old, new) for every\n
+    wall time or peak memory that grew by more than threshold times\n
+    Times below min_time seconds are too noisy to compare
+    """
+    old_results = {case_key(result): result for result in old["results"]}
+    regressions = []
+    for result in new["results"]:
+        before = old_results.get(case_key(result))
+        if before is None:
+            continue
+        for metric in ("wall_time", "peak_memory"):
+            if metric == "wall_time" and max(before[metric], result[metric]) < min_time:
+                continue
+            if result[metric] > threshold * before[metric]:
+                regressions.append((case_key(result), metric, before[metric], result[metric]))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the quantum circuit simulator")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--families", nargs="+", default=list(FAMILIES), choices=list(FAMILIES))
+    run_parser.add_argument("--sizes", nargs="+", type=int, default=[4, 8, 12])
+    run_parser.add_argument("--densities", nargs="+", type=float, default=[0.0, 1.0],
+                            help="fraction of the qudits not starting with a Hadamard put in superposition before the circuit")
+    run_parser.add_argument("--backends", nargs="+", default=["sparse", "dense"],
+                            choices=["sparse", "array", "dense", "auto", "memmap"])
+    run_parser.add_argument("--repeat", type=int, default=3)
+    run_parser.add_argument("--out", default="benchmark.json")
+    compare_parser = commands.add_parser("compare", help="compare two benchmark runs")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=1.2,
+                                help="flag results that got this many times slower or bigger")
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        run(args)
+        return 0
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    regressions = compare(old, new, args.threshold)
+    for key, metric, before, after in regressions:
+        print(f"REGRESSION {'/'.join(map(str, key))} {metric}: {before:.6g} --> {after:.6g} ({after/before:.2f}x)")
+    if not regressions:
+        print("No regressions")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,176 @@
+import re
+from collections import defaultdict
+from functools import lru_cache
+import numpy as np
+import gates
+
+class Op:
+    """A compiled gate: the simulator method to call and the arguments to call it with"""
+    __slots__ = ("name", "targets", "params", "func", "args", "symbolic")
+
+    def __init__(self, name, targets, params, func):
+        self.name = name # gate name, "u" for a fused single-qudit matrix
+        self.targets = tuple(targets) # qudits the gate acts on (controls included)
+        self.params = tuple(params) # angles (or parameter names), or the matrix for "u"
+        self.func = func # unbound apply_* method of the simulator class
+        self.args = (*self.targets, *self.params) # or the arguments of apply_compiled, see kernel_args
+        self.symbolic = any(isinstance(p, str) for p in self.params) # True if it needs sweep values
+
+    def matrix(self, values={}):
+        """Matrix of the gate on its targets (controls excluded)\n
+        Parameter names are looked up in values, which may hold arrays of angles
+        """
+        if self.name == "u":
+            return self.params[0]
+        params = []
+        for p in self.params:
+            if isinstance(p, str):
+                if p not in values: raise Exception(f"No values given for parameter {p}")
+                p = values[p]
+            params.append(p)
+        return gates.GATES[self.name][3](*params)
+
+    def controls(self):
+        """Control qudits of the gate as (qudit, value) pairs"""
+        if self.name == "u":
+            return ()
+        return tuple((qc, 1) for qc in self.targets[:gates.GATES[self.name][1]])
+
+    def __repr__(self):
+        return f"Op({self.name}-{','.join(map(str, self.targets))})"
+
+def parse_param(param):
+    """Angles are numbers, anything else is the name of a parameter set by sweep"""
+    try:
+        return float(param)
+    except ValueError:
+        return param.strip()
+
+def parse_gate(gate):
+    """Split a "gateName-target,target,...;param,param,..." string into its name,\n
+    list of targets and list of parameters
+    """
+    gate, _, params = gate.partition(";")
+    gate_name, targets = gate.split("-")
+    params = [parse_param(p) for p in params.split(",")] if params else []
+    return gate_name, [int(qi) for qi in targets.split(",")], params
+
+def parse_pauli(term, qudit):
+    """Split a Pauli string like "X0 Y1 Z3" into (shift, clock, factor)\n
+    shift and clock are sorted tuples of (qudit, power) pairs, for the operator\n
+    factor * (product over qudits of X^shift Z^clock), where X|j> = |j+1 mod qudit>\n
+    and Z|j> = omega^j|j>, omega = e^(2 pi i / qudit)\n
+    For qubits, each qubit may appear once, and Y = iXZ. For qutrits, operators multiply\n
+    in the order of the string: "X0^2 Z0" is X^2 Z on qutrit 0, and "Z0 X0" is ZX = omega XZ
+    """
+    shift, clock = defaultdict(int), defaultdict(int)
+    factor = 1
+    seen = set()
+    for token in term.split():
+        match = re.fullmatch(r"([IXYZ])(\d+)(?:\^(\d+))?", token)
+        if match is None: raise Exception(f"Can't parse Pauli operator {token!r} in {term!r}")
+        letter, qi, power = match.group(1), int(match.group(2)), int(match.group(3) or 1)
+        if (letter, qi) in seen or (qudit == 2 and qi in {q for _,q in seen}):
+            raise Exception(f"Qudit {qi} appears more than once in {term!r}")
+        seen.add((letter, qi))
+        if letter == "Y":
+            if qudit != 2 or match.group(3): raise Exception("Y is only defined for qubits, without a power")
+            shift[qi] += 1
+            clock[qi] += 1
+            factor *= 1j
+        elif letter == "X":
+            # moving X^power left past the Z^clock already on this qudit: Z^b X^a = omega^(ab) X^a Z^b
+            factor *= np.exp(2j * np.pi * (clock[qi] * power % qudit) / qudit) if clock[qi] else 1
+            shift[qi] += power
+        elif letter == "Z":
+            clock[qi] += power
+    shift = tuple(sorted((qi, a % qudit) for qi,a in shift.items() if a % qudit))
+    clock = tuple(sorted((qi, b % qudit) for qi,b in clock.items() if b % qudit))
+    return shift, clock, factor
+
+def check_op(op, qudit, num_qudits=None):
+    """Raise if a parsed gate can't be applied on qudits of size qudit (or on a\n
+    register of num_qudits qudits), before the optimizer gets to cancel it
+    """
+    if op.name in gates.GATES:
+        gate_qudit, num_controls, num_targets, _ = gates.GATES[op.name]
+        if gate_qudit != qudit: raise Exception(f"Gate {op.name} can't be applied on qudits of size {qudit}")
+        if len(op.targets) != num_controls + num_targets: raise Exception(f"Gate {op.name} needs {num_controls + num_targets} qudits")
+    if len(set(op.targets)) != len(op.targets): raise Exception("Control and target qudits need to be unique")
+    if num_qudits is not None and not all(0 <= q < num_qudits for q in op.targets):
+        raise Exception(f"Qudits need to be between 0 and {num_qudits - 1}")
+
+def is_fusable(op, qudit):
+    if op.name == "u":
+        return True
+    return op.name in gates.SINGLE_QUDIT and gates.GATES[op.name][0] == qudit and not op.symbolic
+
+def optimize(ops, qudit, gate_set):
+    """Fuse runs of single-qudit gates on the same qudit into one matrix, and\n
+    cancel pairs of self-inverse gates on the same targets\n
+    Gates on disjoint qudits commute, so only the last gate on each qudit matters
+    """
+    out = [] # optimized ops, None where an op was cancelled
+    last = defaultdict(list) # qudit --> indices into out of the ops touching it
+    for op in ops:
+        prev = {last[qi][-1] if last[qi] else None for qi in op.targets}
+        j = prev.pop() if len(prev) == 1 else None
+        if j is not None and set(out[j].targets) == set(op.targets):
+            prev_op = out[j]
+            cancel = prev_op.name == op.name and prev_op.targets == op.targets and op.name in gates.SELF_INVERSE
+            if not cancel and is_fusable(prev_op, qudit) and is_fusable(op, qudit):
+                fused = op.matrix() @ prev_op.matrix()
+                cancel = np.allclose(fused, np.eye(qudit), atol=1e-12)
+                if not cancel:
+                    out[j] = Op("u", op.targets, (fused,), gate_set.apply_u)
+                    continue
+            if cancel:
+                out[j] = None
+                for qi in op.targets:
+                    last[qi].pop()
+                continue
+        for qi in op.targets:
+            last[qi].append(len(out))
+        out.append(op)
+    return [op for op in out if op is not None]
+
+def kernel_args(op):
+    """(matrix, targets, controls, prune) of a checked op with fixed parameters, the\n
+    arguments of the gate set's apply_compiled (see Simulator.apply_compiled)\n
+    prune is False for gates that only permute basis states and multiply by phases,\n
+    since they can't create rounding errors
+    """
+    matrix = np.ascontiguousarray(op.matrix(), dtype=complex)
+    controls = op.controls()
+    nonzero = matrix != 0
+    prune = not ((nonzero.sum(axis=0) == 1).all() and np.allclose(np.abs(matrix[nonzero]), 1))
+    return matrix, op.targets[len(controls):], controls, prune
+
+@lru_cache(maxsize=256)
+def _compile(circuit, qudit, gate_set, optimized, num_qudits):
+    ops = []
+    for gate in circuit:
+        gate_name, targets, params = parse_gate(gate)
+        func = getattr(gate_set, f"apply_{gate_name}", None)
+        if func is None: raise Exception(f"Unknown gate: {gate}")
+        op = Op(gate_name, targets, params, func)
+        check_op(op, qudit, num_qudits)
+        ops.append(op)
+    if optimized:
+        ops = optimize(ops, qudit, gate_set)
+    # ops were checked above, so gate sets with apply_compiled get their matrices directly
+    apply_compiled = getattr(gate_set, "apply_compiled", None)
+    if apply_compiled is not None:
+        for op in ops:
+            if not op.symbolic and (op.name == "u" or op.name in gates.GATES):
+                op.func, op.args = apply_compiled, kernel_args(op)
+    return tuple(ops)
+
+def compile_circuit(circuit, qudit, gate_set, optimized=True, num_qudits=None):
+    """Turn a list of "gateName-targets;params" strings into a tuple of Ops for the\n
+    apply_* methods of gate_set (normally the Simulator class)\n
+    Every gate is checked first (see check_op), so invalid gates raise even when they\n
+    would cancel out\n
+    Results are cached by circuit content, so recompiling the same circuit is free
+    """
+    return _compile(tuple(circuit), qudit, gate_set, optimized, num_qudits)
@@ -0,0 +1,92 @@
+import cmath
+import numpy as np
+
+# Matrices for the supported gates. Columns are the images of the basis states,
+# so gate[j, k] is the amplitude of |j> in gate|k>. For multi-qudit gates the
+# local basis index uses the first target as the least significant digit.
+
+X = np.array([[0, 1],
+              [1, 0]], dtype=complex)
+
+Y = np.array([[0, -1j],
+              [1j, 0]], dtype=complex)
+
+Z = np.array([[1, 0],
+              [0, -1]], dtype=complex)
+
+H = np.array([[1, 1],
+              [1, -1]], dtype=complex) / cmath.sqrt(2)
+
+# omega = e^(i*2pi/3), H3[j, k] = omega^(j*k) / sqrt(3)
+_omega = -0.5 + 1j*cmath.sqrt(3)/2
+H3 = np.array([[1, 1, 1],
+               [1, _omega, _omega**2],
+               [1, _omega**2, _omega]], dtype=complex) / cmath.sqrt(3)
+
+def _matrix(rows):
+    """Build a matrix from rows of entries, or a stack of matrices (shape (..., D, D))\n
+    if some entries are arrays, e.g. when sweeping over many angles at once
+    """
+    entries = np.array(np.broadcast_arrays(*[entry for row in rows for entry in row]), dtype=complex)
+    entries = entries.reshape((len(rows), len(rows)) + entries.shape[1:])
+    return np.moveaxis(entries, (0, 1), (-2, -1))
+
+def phase(phi):
+    """Matrix of the phase (P) gate with angle phi"""
+    return _matrix([[1, 0],
+                    [0, np.exp(1j*phi)]])
+
+def Rx(theta):
+    """Matrix of the Rx (Rotation around X) gate with angle theta"""
+    c, s = np.cos(np.divide(theta, 2)), np.sin(np.divide(theta, 2))
+    return _matrix([[c, -1j*s],
+                    [-1j*s, c]])
+
+def Ry(theta):
+    """Matrix of the Ry (Rotation around Y) gate with angle theta"""
+    c, s = np.cos(np.divide(theta, 2)), np.sin(np.divide(theta, 2))
+    return _matrix([[c, -s],
+                    [s, c]])
+
+def Rz(theta):
+    """Matrix of the Rz (Rotation around Z) gate with angle theta"""
+    return _matrix([[np.exp(-0.5j*np.asarray(theta)), 0],
+                    [0, np.exp(0.5j*np.asarray(theta))]])
+
+def swap(d):
+    """Matrix of the Swap gate on two qudits of dimension d"""
+    result = np.zeros((d*d, d*d), dtype=complex)
+    for a in range(d):
+        for b in range(d):
+            # |a,b> --> |b,a>
+            result[b + d*a, a + d*b] = 1
+    return result
+
+SWAP = swap(2)
+SWAP3 = swap(3)
+
+# every named gate as name: (qudit, number of controls, number of targets, matrix function of
+# the gate's parameters). The gate's qudit arguments are its controls (control value 1) followed
+# by its targets, and the matrix only acts on the targets
+GATES = {
+    "x": (2, 0, 1, lambda: X),
+    "y": (2, 0, 1, lambda: Y),
+    "z": (2, 0, 1, lambda: Z),
+    "h": (2, 0, 1, lambda: H),
+    "phase": (2, 0, 1, phase),
+    "Rx": (2, 0, 1, Rx),
+    "Ry": (2, 0, 1, Ry),
+    "Rz": (2, 0, 1, Rz),
+    "swap": (2, 0, 2, lambda: SWAP),
+    "cx": (2, 1, 1, lambda: X),
+    "cswap": (2, 1, 2, lambda: SWAP),
+    "ccx": (2, 2, 1, lambda: X),
+    "h3": (3, 0, 1, lambda: H3),
+    "cswap3": (3, 1, 2, lambda: SWAP3),
+}
+
+# single-qudit gates the compiler can fuse into one matrix
+SINGLE_QUDIT = {name for name,(qudit,controls,targets,f) in GATES.items() if controls == 0 and targets == 1}
+
+# gates that undo themselves when applied twice on the same targets
+SELF_INVERSE = {"x", "y", "z", "h", "cx", "ccx", "swap", "cswap", "cswap3"}
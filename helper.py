@@ -1,4 +1,7 @@
 import sys
+import zipfile
+import numpy as np
+from states import to_arrays
 
 def int_to_bstring(n: int, b: int) -> str:
     """Returns a string representation of n in base b\n
@@ -6,30 +9,85 @@ def int_to_bstring(n: int, b: int) -> str:
     """
     if n == 0:
         return "0"
-    result = ""
+    digits = []
     while n:
-        result += str(n % b)
+        digits.append(str(n % b))
         n //= b
-    return result[::-1]
+    return "".join(reversed(digits))
 
-def print_sim(sim, b10=False, f=sys.stdout):
-    """Print the history (or at least the final state) of the simulator\n
-    Print basis vectors as |01001...> by default\n
-    If b10=True, print as ints in base 10
+def basis_labels(indices, b, width):
+    """Returns the string representations of an array of basis states in base b,\n
+    zero-padded to width digits, all at once\n
+    Need b <= 10
+    """
+    indices = np.asarray(indices)
+    if len(indices) == 0:
+        return []
+    width = max(width, len(int_to_bstring(int(indices.max()), b)))
+    powers = np.array([b**k for k in reversed(range(width))], dtype=indices.dtype)
+    digits = (indices[:, None] // powers) % b + ord("0")
+    return digits.astype(np.uint8).view(f"S{width}").ravel().astype(str).tolist()
+
+def iter_states(sim):
+    """Yield the history (or at least the final state) of the simulator one step\n
+    at a time, as (gate, basis states, amplitudes) with the basis states sorted\n
+    gate is the gate applied after that state, or None for the last one\n
+    Only one state of the history is rebuilt at a time
     """
     hist = [sim.state]
+    offset = 0 # index in sim.circuit of the gate after hist[0]
     if sim.trackHistory:
         hist = sim.history
+        offset = hist.offset
     for t in range(len(hist)):
-        if b10:
-            basis_states = [(str(num), round(amp.real,4) + round(amp.imag, 4)*1j) for num,amp in sorted(hist[t].items())]
-        else:
-            basis_states = [(int_to_bstring(num, sim.qudit).zfill(sim.num_qudits), round(amp.real,4) + round(amp.imag, 4)*1j) for num,amp in sorted(hist[t].items())]
-        result = ""
-        for s,a in basis_states:
-            if a.imag == 0:
-                a = a.real
-            result += f"{a}|{s}> + "
-        print(f"|Psi> = {result[:-3]}", file=f)
-        if sim.circuit and t < len(hist) - 1:
-            print(f"{sim.circuit[t]}", file=f)
\ No newline at end of file
+        indices, amps = to_arrays(hist[t], sim.qudit**sim.num_qudits)
+        order = np.argsort(indices, kind="stable")
+        gate = sim.circuit[t + offset] if sim.circuit and t < len(hist) - 1 else None
+        yield gate, indices[order], amps[order]
+
+def format_state(indices, amps, sim, b10=False):
+    """Returns the "|Psi> = a|01..> + ..." line for one state, see print_sim"""
+    if b10:
+        labels = [str(num) for num in indices.tolist()]
+    else:
+        labels = basis_labels(indices, sim.qudit, sim.num_qudits)
+    terms = []
+    for s,amp in zip(labels, amps.tolist()):
+        a = round(amp.real,4) + round(amp.imag, 4)*1j
+        if a.imag == 0:
+            a = a.real
+        terms.append(f"{a}|{s}>")
+    return f"|Psi> = {' + '.join(terms)}"
+
+def print_sim(sim, b10=False, f=sys.stdout):
+    """Print the history (or at least the final state) of the simulator\n
+    Print basis vectors as |01001...> by default\n
+    If b10=True, print as ints in base 10
+    """
+    for gate,indices,amps in iter_states(sim):
+        print(format_state(indices, amps, sim, b10), file=f)
+        if gate is not None:
+            print(gate, file=f)
+
+def export_csv(sim, f=sys.stdout, b10=False):
+    """Write the history (or at least the final state) of the simulator as CSV\n
+    with one row per nonzero amplitude: step, gate applied after the step,\n
+    basis state, real and imaginary part of the amplitude
+    """
+    print("step,gate,basis_state,real,imag", file=f)
+    for t,(gate,indices,amps) in enumerate(iter_states(sim)):
+        labels = indices.tolist() if b10 else basis_labels(indices, sim.qudit, sim.num_qudits)
+        gate = f'"{gate}"' if gate is not None else ""
+        f.writelines(f"{t},{gate},{s},{a.real!r},{a.imag!r}\n" for s,a in zip(labels, amps.tolist()))
+
+def export_npz(sim, path):
+    """Write the history (or at least the final state) of the simulator to an\n
+    .npz file, one step at a time, with arrays indices_t (int64 basis states)\n
+    and amps_t (complex128 amplitudes) for each step t\n
+    Read it back with numpy.load(path)
+    """
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for t,(gate,indices,amps) in enumerate(iter_states(sim)):
+            for name,array in [(f"indices_{t}", indices), (f"amps_{t}", amps)]:
+                with zf.open(f"{name}.npy", "w", force_zip64=True) as out:
+                    np.lib.format.write_array(out, np.ascontiguousarray(array))
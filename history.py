@@ -0,0 +1,123 @@
+from collections import defaultdict
+from collections.abc import Sequence
+import numpy as np
+from states import DenseState, SparseState
+
+class History(Sequence):
+    """States of a simulator after each time-step / gate\n
+    Instead of a full copy per step, keeps a full checkpoint every checkpoint_every\n
+    steps and only the changed amplitudes in between. history[k] rebuilds the state\n
+    at step k from the closest checkpoint before it\n
+    With max_steps set, only the last max_steps steps are kept
+    """
+    def __init__(self, checkpoint_every=16, max_steps=None):
+        if checkpoint_every < 1: raise Exception("checkpoint_every needs to be at least 1")
+        if max_steps is not None and max_steps < 1: raise Exception("max_steps needs to be at least 1")
+        self.checkpoint_every = checkpoint_every
+        self.max_steps = max_steps
+        self.entries = [] # (is_checkpoint, full state or delta) for each stored step
+        self.base = 0 # step number of entries[0]
+        self.offset = 0 # step number of history[0], steps before it were dropped
+        self.since_checkpoint = 0 # steps stored since the last checkpoint
+        self.last = None # state at the latest step, to compute the next delta
+        self.cached = (None, None) # (step, state) of the last rebuilt state
+
+    def __len__(self):
+        return self.base + len(self.entries) - self.offset
+
+    def append(self, state):
+        """Record the state after the next step"""
+        delta = None
+        if self.last is not None and self.since_checkpoint < self.checkpoint_every - 1:
+            delta = diff(self.last, state)
+        # a delta touching most of the state saves nothing, store it in full instead
+        if delta is None or len(delta[0]) * 2 > len(state):
+            self.entries.append((True, copy_state(state)))
+            self.since_checkpoint = 0
+        else:
+            self.entries.append((False, delta))
+            self.since_checkpoint += 1
+        self.last = state
+        if self.max_steps is not None and len(self) > self.max_steps:
+            self.offset = self.base + len(self.entries) - self.max_steps
+            # drop everything before the checkpoint needed to rebuild history[0]
+            first = self.offset - self.base
+            while not self.entries[first][0]:
+                first -= 1
+            del self.entries[:first]
+            self.base += first
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self[i] for i in range(*k.indices(len(self)))]
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self): raise IndexError("history index out of range")
+        i = k + self.offset - self.base # index into self.entries
+        cached_step, state = self.cached
+        if cached_step is not None and self.base <= cached_step <= i + self.base and not any(
+                is_checkpoint for is_checkpoint,_ in self.entries[cached_step - self.base + 1:i + 1]):
+            start = cached_step - self.base + 1
+            state = copy_state(state)
+        else:
+            start = i
+            while not self.entries[start][0]:
+                start -= 1
+            state = copy_state(self.entries[start][1])
+            start += 1
+        for j in range(start, i + 1):
+            state = apply_delta(state, self.entries[j][1])
+        self.cached = (i + self.base, state)
+        return copy_state(state)
+
+def copy_state(state):
+    """Copy a state so later changes to it don't leak into the history"""
+    if isinstance(state, DenseState):
+        return DenseState(state.vec.copy())
+    if isinstance(state, SparseState):
+        return state # never changed in place, apply_delta makes a new one
+    return defaultdict(int, state)
+
+def diff(old, new):
+    """Changed amplitudes from old to new as (basis states, amplitudes), or None\n
+    if old and new are different kinds of state
+    """
+    if isinstance(old, DenseState) != isinstance(new, DenseState) or isinstance(old, SparseState) != isinstance(new, SparseState):
+        return None
+    if isinstance(new, DenseState):
+        if len(old.vec) != len(new.vec):
+            return None
+        indices = np.flatnonzero(old.vec != new.vec)
+        return indices, new.vec[indices]
+    if isinstance(new, SparseState):
+        indices = np.union1d(old.indices, new.indices)
+        amps = new.lookup(indices)
+        changed = old.lookup(indices) != amps
+        return indices[changed], amps[changed]
+    changed = {basis_state: amp for basis_state,amp in new.items() if old.get(basis_state, 0) != amp}
+    for basis_state in old.keys():
+        if basis_state not in new:
+            changed[basis_state] = 0
+    return list(changed.keys()), list(changed.values())
+
+def apply_delta(state, delta):
+    """Apply a delta from diff onto state (in place, except for a SparseState) and return it"""
+    indices, amps = delta
+    if isinstance(state, DenseState):
+        state.vec[indices] = amps
+        return state
+    if isinstance(state, SparseState):
+        # the delta's amplitudes come after the old ones, keep the last of each basis state
+        indices = np.concatenate([state.indices, indices])
+        amps = np.concatenate([state.amps, amps])
+        order = np.argsort(indices, kind="stable")
+        indices, amps = indices[order], amps[order]
+        last = np.concatenate((indices[1:] != indices[:-1], [True]))
+        keep = last & (amps != 0)
+        return SparseState(indices[keep], amps[keep])
+    for basis_state,amp in zip(indices, amps):
+        if amp == 0:
+            state.pop(basis_state, None)
+        else:
+            state[basis_state] = amp
+    return state
@@ -0,0 +1,346 @@
+import itertools
+from collections import defaultdict
+from functools import lru_cache
+import numpy as np
+
+@lru_cache(maxsize=1024)
+def target_table(qudit, targets):
+    """Strides of the target qudits and the offset of each local basis state of a\n
+    gate on them (local index = digits of the targets, first target least significant)\n
+    Cached, since large circuits apply gates on the same targets many times
+    """
+    strides = tuple(qudit**qi for qi in targets)
+    offsets = [0]
+    for stride in strides:
+        offsets = [offset + digit*stride for digit in range(qudit) for offset in offsets]
+    return strides, tuple(offsets)
+
+@lru_cache(maxsize=1024)
+def sparse_tables(qudit, targets, data):
+    """Lookup tables of a gate matrix (given by its bytes, data) on the target qudits for\n
+    the sparse kernels: the strides and offsets of target_table, the images of each local\n
+    basis state as (offset, coefficient) pairs keyed by its offset, and the nonzero\n
+    entries of each row as (row offset, [(local basis state, coefficient), ...])\n
+    Cached, since circuits apply the same few matrices (the constants in gates.py, or\n
+    the ones a compiled op holds) on the same targets many times
+    """
+    strides, offsets = target_table(qudit, targets)
+    matrix = np.frombuffer(data, dtype=complex).reshape(len(offsets), len(offsets))
+    columns = {offset: [] for offset in offsets}
+    rows, cols = np.nonzero(matrix)
+    for j,l,coeff in zip(rows.tolist(), cols.tolist(), matrix[rows, cols].tolist()):
+        columns[offsets[l]].append((offsets[j], coeff))
+    rows = [(offsets[j], [(l, coeff) for l,coeff in enumerate(row) if coeff != 0]) for j,row in enumerate(matrix.tolist())]
+    return strides, offsets, columns, rows
+
+@lru_cache(maxsize=1024)
+def contraction_axes(ndim, targets, controls):
+    """Index into the (..., qudit, qudit, ...) tensor of a state for the given\n
+    (qudit, value) controls, and the axes of the indexed tensor for each target\n
+    (last target first, the order of the reshaped gate matrix)
+    """
+    idx = [slice(None)] * ndim
+    for qc, value in controls:
+        idx[ndim-1-qc] = value
+    # axes of the (possibly sliced) tensor that the matrix contracts with
+    free_axes = [a for a in range(ndim) if isinstance(idx[a], slice)]
+    return tuple(idx), tuple(free_axes.index(ndim-1-qi) for qi in reversed(targets))
+
+def apply_matrix(vec, matrix, targets, num_qudits, qudit, controls=()):
+    """Apply a gate matrix to a dense state vector and return the new vector\n
+    targets lists the qudits the matrix acts on (first target = least significant\n
+    digit of the matrix's local basis), controls is a list of (qudit, value) pairs\n
+    that must all hold for the gate to be applied\n
+    vec can also be a (batch x basis) array of state vectors, and matrix a\n
+    (batch x D x D) stack with one matrix per row of vec
+    """
+    n = num_qudits
+    k = len(targets)
+    lead = vec.ndim - 1 # 1 if there is a batch axis in front
+    # qudit q lives on axis lead+n-1-q, since qudit 0 is the least significant digit
+    psi = vec.reshape(vec.shape[:lead] + (qudit,) * n)
+    idx, axes = contraction_axes(lead + n, tuple(targets), tuple(controls))
+    axes = list(axes)
+    sub = psi[idx]
+    if matrix.ndim == 2:
+        gate = matrix.reshape((qudit,) * (2*k))
+        result = np.tensordot(gate, sub, axes=(list(range(k, 2*k)), axes))
+        result = np.moveaxis(result, list(range(k)), axes)
+    else:
+        # one matrix per batch row, the batch is axis 0 of both
+        gate = matrix.reshape(matrix.shape[:1] + (qudit,) * (2*k))
+        labels = list(range(sub.ndim))
+        out_labels = list(range(sub.ndim, sub.ndim + k))
+        result_labels = labels.copy()
+        for a, label in zip(axes, out_labels):
+            result_labels[a] = label
+        result = np.einsum(gate, [0] + out_labels + [labels[a] for a in axes], sub, labels, result_labels)
+    if not controls:
+        return result.reshape(vec.shape)
+    out = psi.copy()
+    out[idx] = result
+    return out.reshape(vec.shape)
+
+def apply_sparse(state, matrix, targets, qudit, controls=(), prune=False):
+    """Apply a gate matrix to a sparse {basis_state: amplitude} state and return the\n
+    new state, see apply_matrix\n
+    Basis states outside the controlled subspace are copied over unchanged\n
+    With prune=True, new amplitudes of at most 1e-8 (rounding errors) are left out, see\n
+    apply_sparse_groups
+    """
+    if prune:
+        return apply_sparse_groups(state, matrix, targets, qudit, controls)
+    # images of each local basis state, as (offset, amplitude) pairs skipping zeros,
+    # keyed by the local basis state's offset (= target digits times their strides)
+    strides, offsets, columns, _ = sparse_tables(qudit, tuple(targets), np.asarray(matrix, dtype=complex).tobytes())
+    new_state = defaultdict(int)
+    if qudit == 2:
+        mask = sum(strides) # bits of the target qubits
+        # the controlled subspace is where (basis_state & control_mask) == control_value
+        control_mask = sum(1 << qc for qc,_ in controls) if controls else 0
+        control_value = sum(value << qc for qc,value in controls) if controls else 0
+        for basis_state,amp in state.items():
+            if amp == 0:
+                continue # e.g. left behind by reading state[basis_state] on the dict
+            if basis_state & control_mask != control_value:
+                new_state[basis_state] += amp
+                continue
+            local = basis_state & mask
+            base = basis_state ^ local # basis state with the targets set to 0
+            for offset,coeff in columns[local]:
+                new_state[base + offset] += amp * coeff
+        return new_state
+    control_digits = [(qudit**qc, value) for qc,value in controls]
+    for basis_state,amp in state.items():
+        if amp == 0:
+            continue
+        for stride,value in control_digits:
+            if (basis_state // stride) % qudit != value:
+                break
+        else:
+            local = 0
+            for stride in strides:
+                local += (basis_state // stride) % qudit * stride
+            base = basis_state - local # basis state with the targets set to 0
+            for offset,coeff in columns[local]:
+                new_state[base + offset] += amp * coeff
+            continue
+        new_state[basis_state] += amp # outside the controlled subspace
+    return new_state
+
+def apply_sparse_groups(state, matrix, targets, qudit, controls=(), tol=1e-8):
+    """Apply a gate matrix to a sparse state like apply_sparse, leaving out new amplitudes\n
+    of at most tol\n
+    Basis states that only differ at the targets are handled together, when the first\n
+    nonzero one of them comes up, so each new amplitude is complete (and can be dropped)\n
+    when it is written, without another pass over the new state
+    """
+    # nonzero entries of each row, as (local basis state, coefficient) pairs, with the row's offset
+    strides, offsets, _, rows = sparse_tables(qudit, tuple(targets), np.asarray(matrix, dtype=complex).tobytes())
+    new_state = defaultdict(int)
+    get = state.get
+    if qudit == 2:
+        mask = sum(strides)
+        control_mask = sum(1 << qc for qc,_ in controls) if controls else 0
+        control_value = sum(value << qc for qc,value in controls) if controls else 0
+    else:
+        control_digits = [(qudit**qc, value) for qc,value in controls]
+    if qudit == 2 and len(offsets) == 2:
+        # single-qubit gate, the most common case: the groups are pairs of basis states
+        stride = offsets[1]
+        (m00, m01), (m10, m11) = matrix.tolist()
+        for basis_state,amp in state.items():
+            if basis_state & control_mask != control_value:
+                if amp != 0: new_state[basis_state] = amp
+                continue
+            if basis_state & stride:
+                base = basis_state ^ stride
+                if base in state:
+                    continue
+                amp0, amp1 = 0, amp
+            else:
+                base = basis_state
+                amp0, amp1 = amp, get(basis_state | stride, 0)
+            new_amp = m00 * amp0 + m01 * amp1
+            if abs(new_amp) > tol:
+                new_state[base] = new_amp
+            new_amp = m10 * amp0 + m11 * amp1
+            if abs(new_amp) > tol:
+                new_state[base | stride] = new_amp
+        return new_state
+    for basis_state,amp in state.items():
+        if qudit == 2:
+            if basis_state & control_mask != control_value:
+                if amp != 0: new_state[basis_state] = amp # outside the controlled subspace
+                continue
+            local = basis_state & mask
+        else:
+            if any((basis_state // stride) % qudit != value for stride,value in control_digits):
+                if amp != 0: new_state[basis_state] = amp
+                continue
+            local = 0
+            for stride in strides:
+                local += (basis_state // stride) % qudit * stride
+        base = basis_state - local # basis state with the targets set to 0
+        l = offsets.index(local)
+        if l and any(base + offset in state for offset in offsets[:l]):
+            continue # the group was handled at an earlier member
+        amps = [get(base + offset, 0) for offset in offsets]
+        for offset,row in rows:
+            new_amp = 0
+            for k,coeff in row:
+                new_amp += amps[k] * coeff
+            if abs(new_amp) > tol:
+                new_state[base + offset] = new_amp
+    return new_state
+
+def local_digits(indices, targets, qudit):
+    """Local basis state of each basis state on the targets (first target least significant)"""
+    local = np.zeros(len(indices), dtype=np.int64)
+    for j,qi in enumerate(targets):
+        if qudit == 2:
+            local |= ((indices >> qi) & 1) << j
+        else:
+            local += (indices // qudit**qi) % qudit * qudit**j
+    return local
+
+def in_controls(indices, controls, qudit):
+    """Boolean mask of the basis states where every (qudit, value) control holds"""
+    if qudit == 2:
+        control_mask = sum(1 << qc for qc,_ in controls) if controls else 0
+        control_value = sum(value << qc for qc,value in controls) if controls else 0
+        return (indices & control_mask) == control_value
+    mask = np.ones(len(indices), dtype=bool)
+    for qc,value in controls:
+        mask &= (indices // qudit**qc) % qudit == value
+    return mask
+
+def merge_sorted(indices, amps):
+    """Sort basis states and add up the amplitudes of repeated ones"""
+    order = np.argsort(indices, kind="stable")
+    indices, amps = indices[order], amps[order]
+    if len(indices) < 2:
+        return indices, amps
+    starts = np.flatnonzero(np.concatenate(([True], indices[1:] != indices[:-1])))
+    if len(starts) == len(indices):
+        return indices, amps
+    return indices[starts], np.add.reduceat(amps, starts)
+
+def apply_arrays(indices, amps, matrix, targets, qudit, controls=(), prune=False):
+    """Apply a gate matrix to a sparse state given as sorted arrays of basis states and\n
+    amplitudes, and return the new (indices, amps), see apply_matrix\n
+    Each basis state's image is found for all basis states at once, from the digits at\n
+    the targets (bits for qubits). Gates with one nonzero per column (x, cx, swap, phases,\n
+    ...) just move and scale amplitudes, others create one entry per nonzero matrix\n
+    element, and entries landing on the same basis state are merged after a sort\n
+    With prune=True, merged amplitudes of at most 1e-8 (rounding errors) are left out
+    """
+    strides, offsets = target_table(qudit, tuple(targets))
+    offsets = np.array(offsets, dtype=np.int64)
+    outside = None
+    if controls:
+        mask = in_controls(indices, controls, qudit)
+        if not mask.all():
+            outside = (indices[~mask], amps[~mask])
+            indices, amps = indices[mask], amps[mask]
+    local = local_digits(indices, targets, qudit)
+    base = indices - offsets[local] # basis state with the targets set to 0
+    nonzero = matrix != 0
+    if (nonzero.sum(axis=0) == 1).all():
+        rows = nonzero.argmax(axis=0) # image of each local basis state
+        new_indices = base + offsets[rows[local]]
+        new_amps = amps * matrix[rows, np.arange(len(rows))][local]
+        if (rows != np.arange(len(rows))).any():
+            order = np.argsort(new_indices, kind="stable")
+            new_indices, new_amps = new_indices[order], new_amps[order]
+    else:
+        pieces_indices, pieces_amps = [], []
+        for j in range(len(offsets)):
+            if nonzero[j].any():
+                coeffs = matrix[j, local]
+                keep = coeffs != 0
+                pieces_indices.append(base[keep] + offsets[j])
+                pieces_amps.append(amps[keep] * coeffs[keep])
+        new_indices, new_amps = merge_sorted(np.concatenate(pieces_indices), np.concatenate(pieces_amps))
+        # cancellations, and rounding errors with prune
+        keep = new_amps.real**2 + new_amps.imag**2 > (1e-16 if prune else 0)
+        new_indices, new_amps = new_indices[keep], new_amps[keep]
+    if outside is not None:
+        # states outside the controlled subspace can't collide with the new ones
+        new_indices = np.concatenate([new_indices, outside[0]])
+        new_amps = np.concatenate([new_amps, outside[1]])
+        order = np.argsort(new_indices, kind="stable")
+        new_indices, new_amps = new_indices[order], new_amps[order]
+    return new_indices, new_amps
+
+def parity(values):
+    """Parity of the number of set bits of each (nonnegative) basis state"""
+    if values.dtype == object:
+        return np.array([bin(v).count("1") & 1 for v in values], dtype=np.int64)
+    values = values.copy()
+    for shift in (32, 16, 8, 4, 2, 1):
+        values ^= values >> shift
+    return values & 1
+
+def shift_indices(indices, shift, qudit):
+    """Basis states with the digit of each qudit in shift, a tuple of (qudit, power)\n
+    pairs, raised by power (mod qudit), i.e. the image under that product of X gates
+    """
+    if qudit == 2:
+        return indices ^ sum(1 << qi for qi,_ in shift)
+    out = indices.copy()
+    for qi,power in shift:
+        stride = qudit**qi
+        digit = (indices // stride) % qudit
+        out += ((digit + power) % qudit - digit) * stride
+    return out
+
+def clock_phases(indices, clock, qudit):
+    """omega^(sum of power * digit of each (qudit, power) in clock) for each basis\n
+    state, with omega = e^(2 pi i / qudit), i.e. the phases of that product of Z gates
+    """
+    if qudit == 2:
+        return 1 - 2 * parity(indices & sum(1 << qi for qi,_ in clock))
+    exponent = np.zeros(len(indices), dtype=indices.dtype)
+    for qi,power in clock:
+        exponent += (indices // qudit**qi) % qudit * power
+    roots = np.exp(2j * np.pi * np.arange(qudit) / qudit)
+    return roots[(exponent % qudit).astype(np.int64)]
+
+def chunk_layout(touched, num_qudits, qudit, chunk_size):
+    """Qudits whose values are fixed within each chunk when applying gates on the\n
+    touched qudits: the highest-order other qudits, just enough of them to keep\n
+    chunks at most chunk_size amplitudes (if possible)
+    """
+    free = [q for q in reversed(range(num_qudits)) if q not in touched]
+    fixed = 0
+    while qudit**(num_qudits - fixed) > chunk_size and fixed < len(free):
+        fixed += 1
+    return free[:fixed]
+
+def apply_chunked(vec, gate_list, fixed, num_qudits, qudit, prune=True):
+    """Apply a list of (matrix, targets, controls) gates in place on a state vector\n
+    (e.g. a numpy.memmap), one chunk at a time\n
+    Each chunk holds one value of the fixed qudits, which no gate may touch, so all the\n
+    gates in the list are applied with a single read and write of every chunk\n
+    Returns the magnitude of the new state, after pruning very small amplitudes
+    """
+    n = num_qudits
+    tensor = vec.reshape((qudit,) * n)
+    kept = [q for q in reversed(range(n)) if q not in fixed] # qudits inside a chunk
+    in_chunk = {q: len(kept)-1-i for i,q in enumerate(kept)} # qudit --> qudit within the chunk
+    mag = 0
+    for values in itertools.product(range(qudit), repeat=len(fixed)):
+        idx = [slice(None)] * n
+        for q, value in zip(fixed, values):
+            idx[n-1-q] = value
+        idx = tuple(idx)
+        chunk = np.array(tensor[idx]).reshape(-1)
+        for matrix, targets, controls in gate_list:
+            chunk = apply_matrix(chunk, matrix, [in_chunk[q] for q in targets], len(kept), qudit,
+                                 [(in_chunk[q], value) for q,value in controls])
+        if prune:
+            chunk[np.abs(chunk) <= 1e-8] = 0
+        mag += np.vdot(chunk, chunk).real
+        tensor[idx] = chunk.reshape((qudit,) * len(kept))
+    return mag
@@ -0,0 +1,69 @@
+import sys
+from collections import defaultdict
+from states import DenseState, SparseState
+
+class GateEvent:
+    """What happened when Simulator.run applied one gate, passed to every hook"""
+    __slots__ = ("step", "name", "targets", "elapsed", "nonzero_before", "nonzero_after", "memory")
+
+    def __init__(self, step, name, targets, elapsed, nonzero_before, nonzero_after, memory):
+        self.step = step # index of the gate in the compiled circuit
+        self.name = name # gate name, "u" for a fused single-qudit matrix
+        self.targets = targets # qudits the gate acts on (controls included)
+        self.elapsed = elapsed # seconds spent applying the gate
+        self.nonzero_before = nonzero_before # number of nonzero amplitudes before the gate
+        self.nonzero_after = nonzero_after # and after it
+        self.memory = memory # approximate bytes used by the state after the gate
+
+    def __repr__(self):
+        return (f"GateEvent({self.step}: {self.name}-{','.join(map(str, self.targets))}, "
+                f"{self.elapsed*1e3:.3f} ms, {self.nonzero_before} --> {self.nonzero_after} nonzero)")
+
+def state_memory(state):
+    """Approximate number of bytes used by a state"""
+    if isinstance(state, DenseState):
+        return state.vec.nbytes
+    if isinstance(state, SparseState):
+        return state.indices.nbytes + state.amps.nbytes
+    # the dict itself, plus an int key and a complex amplitude per entry
+    return sys.getsizeof(state) + len(state) * (sys.getsizeof(2**62) + sys.getsizeof(1j))
+
+class Profiler:
+    """Hook for Simulator.run that adds up the time and state growth of each gate type\n
+    sim.add_hook(profiler) then sim.run(), and print(profiler.report())
+    """
+    def __init__(self):
+        self.totals = defaultdict(lambda: [0, 0.0, 0]) # name --> [count, seconds, nonzero amplitudes added]
+        self.gates = 0 # number of gates seen
+        self.time = 0.0 # seconds spent in all gates
+        self.peak = None # event that left the most nonzero amplitudes
+        self.peak_memory = 0 # largest approximate state size in bytes
+
+    def __call__(self, event):
+        totals = self.totals[event.name]
+        totals[0] += 1
+        totals[1] += event.elapsed
+        totals[2] += event.nonzero_after - event.nonzero_before
+        self.gates += 1
+        self.time += event.elapsed
+        if self.peak is None or event.nonzero_after > self.peak.nonzero_after:
+            self.peak = event
+        self.peak_memory = max(self.peak_memory, event.memory)
+
+    def summary(self):
+        """Totals per gate type as {name: (count, seconds, nonzero amplitudes added)},\n
+        slowest first
+        """
+        return {name: tuple(totals) for name,totals in sorted(self.totals.items(), key=lambda item: -item[1][1])}
+
+    def report(self):
+        """Table of the totals per gate type, and the step with the densest state"""
+        lines = [f"{'gate':>8} {'count':>7} {'total ms':>10} {'mean ms':>9} {'time %':>7} {'nonzero +/-':>12}"]
+        for name,(count, seconds, growth) in self.summary().items():
+            share = 100 * seconds / self.time if self.time else 0
+            lines.append(f"{name:>8} {count:>7} {seconds*1e3:>10.3f} {seconds*1e3/count:>9.4f} {share:>7.1f} {growth:>+12}")
+        lines.append(f"{self.gates} gates in {self.time*1e3:.3f} ms, peak state memory ~{self.peak_memory} bytes")
+        if self.peak is not None:
+            lines.append(f"densest state: {self.peak.nonzero_after} nonzero amplitudes after step {self.peak.step} "
+                         f"({self.peak.name}-{','.join(map(str, self.peak.targets))})")
+        return "\n".join(lines)
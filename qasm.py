@@ -0,0 +1,265 @@
+import ast
+import hashlib
+import json
+import math
+import operator
+import os
+import re
+import tempfile
+from functools import lru_cache
+
+# Bump when the parser output changes, so old cache entries are ignored
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "quantum-circuit-sim", "qasm")
+
+# QASM gate --> (number of qubits, function from its parameters to the list of
+# (simulator gate, parameters) applied on the same qubits)
+GATES = {
+    "id": (1, lambda: []),
+    "x": (1, lambda: [("x", ())]),
+    "y": (1, lambda: [("y", ())]),
+    "z": (1, lambda: [("z", ())]),
+    "h": (1, lambda: [("h", ())]),
+    "s": (1, lambda: [("phase", (math.pi/2,))]),
+    "sdg": (1, lambda: [("phase", (-math.pi/2,))]),
+    "t": (1, lambda: [("phase", (math.pi/4,))]),
+    "tdg": (1, lambda: [("phase", (-math.pi/4,))]),
+    "rx": (1, lambda theta: [("Rx", (theta,))]),
+    "ry": (1, lambda theta: [("Ry", (theta,))]),
+    "rz": (1, lambda theta: [("Rz", (theta,))]),
+    "u1": (1, lambda lam: [("phase", (lam,))]),
+    "p": (1, lambda lam: [("phase", (lam,))]),
+    # U(theta, phi, lambda) = P(phi) Ry(theta) P(lambda), exactly
+    "u2": (1, lambda phi, lam: [("phase", (lam,)), ("Ry", (math.pi/2,)), ("phase", (phi,))]),
+    "u3": (1, lambda theta, phi, lam: [("phase", (lam,)), ("Ry", (theta,)), ("phase", (phi,))]),
+    "u": (1, lambda theta, phi, lam: [("phase", (lam,)), ("Ry", (theta,)), ("phase", (phi,))]),
+    "U": (1, lambda theta, phi, lam: [("phase", (lam,)), ("Ry", (theta,)), ("phase", (phi,))]),
+    "cx": (2, lambda: [("cx", ())]),
+    "CX": (2, lambda: [("cx", ())]),
+    "swap": (2, lambda: [("swap", ())]),
+    "ccx": (3, lambda: [("ccx", ())]),
+    "cswap": (3, lambda: [("cswap", ())]),
+}
+
+# statements that don't change the state vector
+IGNORED = {"OPENQASM", "include", "creg", "barrier", "measure"}
+
+BINARY = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+          ast.Div: operator.truediv, ast.Pow: operator.pow}
+UNARY = {ast.USub: operator.neg, ast.UAdd: operator.pos}
+TOKENS = re.compile(r"([;{}])")
+NAMES = re.compile(r"\b([A-Za-z_]\w*)")
+CALL = re.compile(r"([A-Za-z_]\w*)\s*(?:\((.*)\))?\s*(.*)", re.S)
+QUBIT = re.compile(r"(\w+)\s*(?:\[\s*(\d+)\s*\])?")
+FUNCTIONS = {"sin": math.sin, "cos": math.cos, "tan": math.tan, "exp": math.exp, "ln": math.log, "sqrt": math.sqrt}
+
+@lru_cache(maxsize=4096)
+def parse_expr(expr):
+    """Syntax tree of a QASM parameter expression, cached since circuits repeat them"""
+    # ^ is power in QASM, and names get a prefix so ones like lambda aren't Python keywords
+    source = NAMES.sub(r"q_\1", expr.strip().replace("^", "**"))
+    try:
+        return ast.parse(source, mode="eval").body
+    except SyntaxError:
+        raise Exception(f"Can't evaluate parameter {expr!r}") from None
+
+def evaluate(expr, env={}):
+    """Value of a QASM parameter expression, with the names in env (e.g. the\n
+    parameters of a gate definition) and pi
+    """
+    def value(node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return node.value
+        if isinstance(node, ast.Name):
+            name = node.id[2:] # without the "q_" prefix
+            if name == "pi":
+                return math.pi
+            if name in env:
+                return env[name]
+        elif isinstance(node, ast.BinOp) and type(node.op) in BINARY:
+            return BINARY[type(node.op)](value(node.left), value(node.right))
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in UNARY:
+            return UNARY[type(node.op)](value(node.operand))
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id[2:] in FUNCTIONS and len(node.args) == 1:
+            return FUNCTIONS[node.func.id[2:]](value(node.args[0]))
+        raise Exception(f"Can't evaluate parameter {expr!r}")
+    return float(value(parse_expr(expr)))
+
+def statements(lines):
+    """Yield the (line number, statement, body) of each statement in an iterable of\n
+    QASM lines, reading one line at a time\n
+    body is the list of statements inside a gate definition's braces, or None
+    """
+    buf = []
+    header = body = None
+    start = None # line number where the current statement starts
+    for number,line in enumerate(lines, 1):
+        for token in TOKENS.split(line.split("//", 1)[0]):
+            if token == ";":
+                statement = "".join(buf).strip()
+                buf = []
+                if body is not None:
+                    body.append(statement)
+                elif statement:
+                    yield start, statement, None
+            elif token == "{":
+                header, body = "".join(buf).strip(), []
+                buf = []
+            elif token == "}":
+                if body is None or "".join(buf).strip(): raise Exception(f"Line {number}: unexpected }}")
+                yield start, header, [statement for statement in body if statement]
+                header = body = None
+            elif token.strip():
+                if not buf or not "".join(buf).strip():
+                    start = number
+                buf.append(token)
+    if "".join(buf).strip() or body is not None: raise Exception("Unexpected end of file, missing ; or }")
+
+def split_params(params):
+    """Split a parameter list on the commas outside parentheses"""
+    if "(" not in params:
+        return [part.strip() for part in params.split(",") if part.strip()]
+    parts, depth, current = [], 0, []
+    for char in params:
+        if char == "," and depth == 0:
+            parts.append("".join(current))
+            current = []
+            continue
+        depth += (char == "(") - (char == ")")
+        current.append(char)
+    parts.append("".join(current))
+    return [part.strip() for part in parts if part.strip()]
+
+def split_call(statement):
+    """Split "name(params) arg, arg" into name, list of parameters, list of args"""
+    match = CALL.fullmatch(statement)
+    if match is None: raise Exception(f"Can't parse statement {statement!r}")
+    name, params, args = match.groups()
+    return name, split_params(params or ""), [arg.strip() for arg in args.split(",") if arg.strip()]
+
+class QasmParser:
+    """OpenQASM 2.0 to a list of simulator gate strings, one statement at a time\n
+    Qubits of all the qregs are numbered in order of declaration, so the first qubit\n
+    of the first qreg is qubit 0 (the least significant)
+    """
+    def __init__(self):
+        self.registers = {} # qreg name --> (first qubit, size)
+        self.num_qubits = 0
+        self.definitions = {} # custom gate name --> (parameter names, qubit names, body)
+        self.circuit = []
+        self.expanded = {} # gate statement --> the gate strings it expanded to, since circuits repeat them
+
+    def feed(self, lines):
+        """Parse an iterable of QASM lines (e.g. an open file)"""
+        for number,statement,body in statements(lines):
+            try:
+                self.statement(statement, body)
+            except Exception as e:
+                raise Exception(f"Line {number}: {e}") from None
+        return self
+
+    def statement(self, statement, body):
+        if statement in self.expanded and body is None:
+            self.circuit += self.expanded[statement]
+            return
+        name, params, args = split_call(statement)
+        if body is not None:
+            if name != "gate": raise Exception(f"Unexpected block after {name}")
+            gate, gate_params, qubits = split_call(statement[len("gate"):].strip())
+            self.definitions[gate] = (gate_params, qubits, [split_call(s) for s in body])
+            self.expanded.clear() # the new gate may shadow a gate used before
+        elif name == "qreg":
+            match = re.fullmatch(r"(\w+)\s*\[\s*(\d+)\s*\]", args[0]) if len(args) == 1 else None
+            if match is None: raise Exception(f"Can't parse qreg {statement!r}")
+            self.registers[match.group(1)] = (self.num_qubits, int(match.group(2)))
+            self.num_qubits += int(match.group(2))
+        elif name in IGNORED:
+            pass
+        elif name in ("opaque", "reset", "if"):
+            raise Exception(f"{name} is not supported")
+        else:
+            start = len(self.circuit)
+            values = [evaluate(p) for p in params]
+            qubits = [self.qubits(arg) for arg in args]
+            # a whole register as an argument applies the gate once per qubit in it
+            sizes = {len(q) for q in qubits if len(q) > 1}
+            if len(sizes) > 1: raise Exception(f"Registers of different sizes in {statement!r}")
+            for i in range(sizes.pop() if sizes else 1):
+                self.gate(name, values, [q[i] if len(q) > 1 else q[0] for q in qubits])
+            self.expanded[statement] = self.circuit[start:]
+
+    def qubits(self, arg):
+        """Qubit numbers of an argument: [n] for reg[i], all of them for reg"""
+        match = QUBIT.fullmatch(arg)
+        if match is None or match.group(1) not in self.registers: raise Exception(f"Unknown qubit {arg!r}")
+        first, size = self.registers[match.group(1)]
+        if match.group(2) is None:
+            return list(range(first, first + size))
+        if int(match.group(2)) >= size: raise Exception(f"{arg} is out of range")
+        return [first + int(match.group(2))]
+
+    def gate(self, name, values, qubits):
+        """Append a gate call with evaluated parameters, expanding custom gates"""
+        if len(set(qubits)) != len(qubits): raise Exception(f"Repeated qubit in {name}")
+        if name in self.definitions:
+            params, names, body = self.definitions[name]
+            if len(values) != len(params) or len(qubits) != len(names): raise Exception(f"Wrong number of arguments for {name}")
+            env = dict(zip(params, values))
+            wires = dict(zip(names, qubits))
+            for gate, gate_params, args in body:
+                if gate == "barrier":
+                    continue
+                if not all(arg in wires for arg in args): raise Exception(f"Unknown qubit in gate {name}")
+                self.gate(gate, [evaluate(p, env) for p in gate_params], [wires[arg] for arg in args])
+        elif name in GATES:
+            num_qubits, expand = GATES[name]
+            if len(qubits) != num_qubits: raise Exception(f"{name} needs {num_qubits} qubits")
+            try:
+                gates = expand(*values)
+            except TypeError:
+                raise Exception(f"Wrong number of parameters for {name}") from None
+            targets = ",".join(map(str, qubits))
+            for gate, params in gates:
+                self.circuit.append(f"{gate}-{targets};{','.join(map(repr, params))}" if params else f"{gate}-{targets}")
+        else:
+            raise Exception(f"Unknown gate {name}")
+
+def parse_qasm(lines):
+    """Parse OpenQASM 2.0 from an iterable of lines (e.g. an open file) into\n
+    (number of qubits, list of simulator gate strings)
+    """
+    parser = QasmParser().feed(lines)
+    return parser.num_qubits, parser.circuit
+
+def file_hash(path):
+    """sha256 of a file's contents, read in blocks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_qasm(path, cache_dir=DEFAULT_CACHE_DIR):
+    """Parse an OpenQASM 2.0 file into (number of qubits, list of simulator gate strings)\n
+    The result is cached as JSON in cache_dir, keyed by the hash of the file's contents,\n
+    so loading the same file again skips parsing. cache_dir=None disables the cache
+    """
+    if cache_dir is None:
+        with open(path) as f:
+            return parse_qasm(f)
+    cached = os.path.join(cache_dir, f"{file_hash(path)}-v{CACHE_VERSION}.json")
+    try:
+        with open(cached) as f:
+            data = json.load(f)
+        return data["num_qubits"], data["circuit"]
+    except (OSError, ValueError, KeyError):
+        pass
+    with open(path) as f:
+        num_qubits, circuit = parse_qasm(f)
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary file first, so a crash never leaves half a cache entry
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump({"num_qubits": num_qubits, "circuit": circuit}, f)
+    os.replace(tmp, cached)
+    return num_qubits, circuit
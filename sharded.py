@@ -0,0 +1,245 @@
+import multiprocessing
+from collections import defaultdict
+import numpy as np
+import gates
+from simulator import Simulator
+from compiler import compile_circuit
+from states import DenseState, SparseState, to_arrays
+
+# gate to apply on a shard once its controls on sharded qudits are known to hold,
+# by gate name and number of controls left
+REDUCED = {
+    ("cx", 0): "x",
+    ("ccx", 0): "x",
+    ("ccx", 1): "cx",
+    ("cswap", 0): "swap",
+}
+
+class ShardedSimulator:
+    def __init__(self, num_qudits, qudit=2, circuit=[], init_state={0: 1}, shard_qudits=1,
+                 backend="sparse", validate="end"):
+        """Simulator that splits the basis states across qudit**shard_qudits worker\n
+        processes, one shard per value of the shard_qudits highest-order qudits\n
+        Gates on the other ("local") qudits run inside each shard without any\n
+        communication, as do gates whose only sharded qudits are controls. A gate that\n
+        targets a sharded qudit first swaps it with a local qudit, which needs an\n
+        exchange of amplitudes between the shards\n
+        backend is the backend of each shard, see Simulator
+        """
+        if not 0 < shard_qudits < num_qudits: raise Exception("Need at least one sharded and one local qudit")
+        if qudit**num_qudits > 2**63: raise Exception("Sharded states need qudit**num_qudits <= 2**63")
+        self.num_qudits = num_qudits # number of qubits/qutrits
+        self.qudit = qudit # 2 for qubits, 3 for qutrits
+        self.circuit = circuit # list of gates in the circuit
+        self.shard_qudits = shard_qudits # number of high-order qudits used to pick the shard
+        self.num_local = num_qudits - shard_qudits # number of qudits inside each shard
+        self.num_shards = qudit**shard_qudits
+        self.backend = backend
+        self.validate = validate
+        self.exchanges = 0 # number of exchange steps in the last run
+        # like a regular simulator, drop tiny amplitudes, normalize, and give the lowest basis
+        # state a real positive amplitude, but only once each shard is split off (start_workers)
+        kept = {basis_state: amp for basis_state,amp in init_state.items() if abs(amp)**2 > 1e-16}
+        lowest = kept[min(kept)]
+        self.scale = abs(lowest) / lowest / sum(abs(amp)**2 for amp in kept.values())**0.5
+        self.state = init_state # initial state until run(), then the gathered SparseState
+
+    def run(self):
+        """Run self.circuit on the shards, then gather the final state into self.state"""
+        self.layout = list(range(self.num_qudits)) # layout[qudit] = its position in the shards
+        self.exchanges = 0
+        ops = compile_circuit(self.circuit, self.qudit, Simulator, True, self.num_qudits)
+        self.start_workers()
+        try:
+            pending = [] # local ops not sent to the workers yet
+            for i,op in enumerate(ops):
+                if op.symbolic: raise Exception("Circuit has named parameters, use Simulator.sweep instead")
+                num_controls = gates.GATES[op.name][1] if op.name != "u" else 0
+                controls = list(op.targets[:num_controls])
+                targets = op.targets[num_controls:]
+                sharded_controls = [qc for qc in controls if self.layout[qc] >= self.num_local]
+                local_controls = [qc for qc in controls if qc not in sharded_controls]
+                name = REDUCED.get((op.name, len(local_controls)), op.name) if sharded_controls else op.name
+                if name == op.name: # can't drop the sharded controls, bring them in as well
+                    targets = op.targets
+                    sharded_controls, local_controls = [], controls
+                for qi in targets:
+                    if self.layout[qi] >= self.num_local:
+                        self.send_all(("run", pending))
+                        pending = []
+                        self.remap(qi, op.targets, ops[i+1:])
+                conditions = [(self.layout[qc] - self.num_local, 1) for qc in sharded_controls]
+                args = [self.layout[q] for q in local_controls + list(op.targets[num_controls:])]
+                pending.append((name, (*args, *op.params), conditions))
+            self.send_all(("run", pending))
+            self.state = self.gather()
+        finally:
+            self.stop_workers()
+        if self.validate != "never":
+            mag = np.vdot(self.state.amps, self.state.amps).real
+            if abs(1 - mag) > 1e-8: raise Exception(f"State is not normalized: {self.state}")
+        return self.state
+
+    def shards(self):
+        """Basis states (within the shard) and amplitudes of self.state, for each shard in turn"""
+        local_dim = self.qudit**self.num_local
+        state = self.state
+        if not isinstance(state, SparseState):
+            # the initial dict, in one pass: sorted arrays without tiny amplitudes, normalized
+            indices, amps = to_arrays(state, self.qudit**self.num_qudits)
+            keep = amps.real**2 + amps.imag**2 > 1e-16
+            order = np.argsort(indices[keep], kind="stable")
+            state = SparseState(indices[keep][order], amps[keep][order] * self.scale)
+        # sorted basis states, so each shard is one slice
+        bounds = np.searchsorted(state.indices, np.arange(self.num_shards + 1) * local_dim)
+        for s in range(self.num_shards):
+            yield state.indices[bounds[s]:bounds[s+1]] - s * local_dim, state.amps[bounds[s]:bounds[s+1]]
+
+    def start_workers(self):
+        """Start one worker process per shard, sending each its part of self.state\n
+        Workers whose shards differ in one sharded digit also get a pipe between them, for\n
+        the exchanges of remap
+        """
+        digits = [[(s // self.qudit**j) % self.qudit for j in range(self.shard_qudits)] for s in range(self.num_shards)]
+        peers = [{} for _ in range(self.num_shards)] # shard --> {other shard: connection to it}
+        for s in range(self.num_shards):
+            for j in range(self.shard_qudits):
+                for b in range(digits[s][j] + 1, self.qudit):
+                    t = s + (b - digits[s][j]) * self.qudit**j
+                    peers[s][t], peers[t][s] = multiprocessing.Pipe()
+        self.connections = []
+        self.workers = []
+        for s,(indices, amps) in enumerate(self.shards()):
+            parent_end, worker_end = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=run_worker, daemon=True,
+                                             args=(worker_end, peers[s], self.num_local, self.qudit, self.backend,
+                                                   digits[s], indices, amps))
+            worker.start()
+            self.connections.append(parent_end)
+            self.workers.append(worker)
+
+    def stop_workers(self):
+        for conn in self.connections:
+            conn.send(("stop",))
+        for worker in self.workers:
+            worker.join()
+
+    def send_all(self, message):
+        """Send a message to every worker and return their replies"""
+        if message[0] == "run" and not message[1]:
+            return
+        for conn in self.connections:
+            conn.send(message)
+        replies = [conn.recv() for conn in self.connections]
+        for reply in replies:
+            if isinstance(reply, Exception): raise reply
+        return replies
+
+    def remap(self, qi, busy, upcoming):
+        """Swap sharded qudit qi with a local qudit that isn't in busy and is needed\n
+        again the latest in upcoming, exchanging amplitudes between the shards
+        """
+        busy_positions = {self.layout[q] for q in busy}
+        position_of = {p: q for q,p in enumerate(self.layout)}
+        def next_use(p):
+            for i,op in enumerate(upcoming):
+                if position_of[p] in op.targets:
+                    return i
+            return len(upcoming)
+        free = [p for p in range(self.num_local) if p not in busy_positions]
+        if not free: raise Exception(f"Gates on {len(busy)} qudits need more than {self.num_local} local qudits")
+        local = max(free, key=next_use)
+        sharded = self.layout[qi]
+        # each worker swaps pieces of its shard with the workers differing in that sharded digit
+        self.send_all(("exchange", local, sharded - self.num_local))
+        other = position_of[local]
+        self.layout[qi], self.layout[other] = local, sharded
+        self.exchanges += 1
+
+    def gather(self):
+        """Collect the shards into one SparseState, one shard at a time"""
+        local_dim = self.qudit**self.num_local
+        pieces_indices, pieces_amps = [], []
+        for s,conn in enumerate(self.connections):
+            conn.send(("state",))
+            indices, amps = conn.recv()
+            indices = indices + s * local_dim
+            # positions in the shards back to qudits
+            result = np.zeros(len(indices), dtype=np.int64)
+            for q,p in enumerate(self.layout):
+                result += (indices // self.qudit**p) % self.qudit * self.qudit**q
+            pieces_indices.append(result)
+            pieces_amps.append(amps)
+        indices, amps = np.concatenate(pieces_indices), np.concatenate(pieces_amps)
+        order = np.argsort(indices, kind="stable")
+        return SparseState(indices[order], amps[order])
+
+def set_shard(sim, indices, amps):
+    """Set the state of a worker's simulator from arrays of basis states and amplitudes,\n
+    straight in the representation of its backend
+    """
+    dim = sim.qudit**sim.num_qudits
+    if sim.backend == "array":
+        order = np.argsort(indices, kind="stable")
+        sim.state = SparseState(indices[order], amps[order])
+    elif sim.backend == "dense" or (sim.backend == "auto" and len(indices) > sim.dense_threshold * dim):
+        vec = sim.state.vec if sim.dense else np.zeros(dim, dtype=complex)
+        vec[:] = 0
+        vec[indices] = amps
+        sim.state = DenseState(vec)
+    else:
+        sim.state = defaultdict(int, zip(indices.tolist(), amps.tolist()))
+
+def exchange(sim, peers, digits, p, j, qudit, num_local):
+    """Swap the digit at local position p with sharded digit j: amplitudes with digit b at p\n
+    go to the shard with digit b at j (and get our digit at p), straight to that worker\n
+    Every pair of workers sends and receives in the same order (lower shard first), so\n
+    they can't both wait to send at once
+    """
+    shard = sum(digit * qudit**k for k,digit in enumerate(digits))
+    indices, amps = to_arrays(sim.state, qudit**num_local)
+    local_digit = (indices // qudit**p) % qudit
+    moved = indices + (digits[j] - local_digit) * qudit**p
+    keep = local_digit == digits[j]
+    pieces = [(moved[keep], amps[keep])]
+    sim.state = defaultdict(int)
+    for b in range(qudit):
+        if b == digits[j]:
+            continue
+        peer = peers[shard + (b - digits[j]) * qudit**j]
+        piece = (moved[local_digit == b], amps[local_digit == b])
+        if b > digits[j]:
+            peer.send(piece)
+            pieces.append(peer.recv())
+        else:
+            pieces.append(peer.recv())
+            peer.send(piece)
+    set_shard(sim, np.concatenate([idx for idx,_ in pieces]), np.concatenate([a for _,a in pieces]))
+
+def run_worker(conn, peers, num_local, qudit, backend, digits, indices, amps):
+    """Main loop of a worker process holding one shard\n
+    digits are the values of the sharded qudits for this shard, peers the connections to\n
+    the workers it exchanges amplitudes with
+    """
+    # the shard isn't normalized on its own, so don't validate
+    sim = Simulator(num_local, qudit, init_state={0: 1}, backend=backend, validate="never")
+    set_shard(sim, indices, amps)
+    del indices, amps
+    while True:
+        command, *args = conn.recv()
+        if command == "run":
+            try:
+                for name,gate_args,conditions in args[0]:
+                    if all(digits[j] == value for j,value in conditions):
+                        getattr(sim, f"apply_{name}")(*gate_args)
+            except Exception as e:
+                conn.send(e) # raised again in the main process
+                continue
+            conn.send(None)
+        elif command == "exchange":
+            exchange(sim, peers, digits, *args, qudit, num_local)
+            conn.send(None)
+        elif command == "state":
+            conn.send(to_arrays(sim.state, qudit**num_local))
+        elif command == "stop":
+            break
@@ -1,36 +1,133 @@
 import cmath
+import time
 from collections import defaultdict
+import numpy as np
+import gates
+from kernels import apply_matrix, apply_sparse, apply_arrays, apply_chunked, chunk_layout, shift_indices, clock_phases
+from compiler import compile_circuit, parse_pauli
+from history import History
+from profiler import GateEvent, state_memory
+from stabilizer import Tableau, StabilizerState, CLIFFORD, STABILIZER_QUBITS
+from states import DenseState, SparseState, to_vector, to_arrays, marginal_outcomes
 from helper import *
 
 class Simulator:
-    def __init__(self, num_qudits, qudit=2, circuit=[], init_state={0: 1}, trackHistory=False):
+    def __init__(self, num_qudits, qudit=2, circuit=[], init_state={0: 1}, trackHistory=False,
+                 backend="sparse", dense_threshold=0.25, checkpoint_every=16, max_history=None,
+                 validate="gate", memmap_path=None, chunk_size=2**20, resume=False):
         """Initialize a Simulator object with the number and type of qudits,\n
         a circuit of gates, and an initial state for the system\n
-        Can also keep track of the history of states at each time-step / gate
+        Can also keep track of the history of states at each time-step / gate\n
+        backend is "sparse" (dict of nonzero amplitudes), "array" (sorted numpy arrays of the\n
+        nonzero basis states and amplitudes), "dense" (full state vector), or "auto" (start sparse, switch to dense once more than dense_threshold\n
+        of all basis states have nonzero amplitude)\n
+        The history keeps a full copy of the state every checkpoint_every steps, and only\n
+        the changed amplitudes in between. With max_history set, only the last max_history\n
+        states are kept\n
+        validate says when to check that the state is still normalized: after every "gate",\n
+        every N gates (an int), only at the "end" of run(), or "never"\n
+        backend "memmap" keeps the dense vector in a file at memmap_path instead of memory,\n
+        and applies gates chunk_size amplitudes at a time. With resume=True, the state is\n
+        read from that file (e.g. left by an earlier run) instead of init_state
         """
+        if backend not in ("sparse", "array", "dense", "auto", "memmap"): raise Exception(f"Unknown backend: {backend}")
+        if backend == "array" and qudit**num_qudits > 2**63: raise Exception("The array backend needs qudit**num_qudits <= 2**63")
+        if backend == "memmap" and memmap_path is None: raise Exception("The memmap backend needs a memmap_path")
+        if backend == "memmap" and trackHistory: raise Exception("The memmap backend can't track history")
+        if validate not in ("gate", "end", "never") and not (type(validate) is int and validate > 0): # bools are ints, but not counts
+            raise Exception(f"Unknown validation mode: {validate}")
         self.num_qudits = num_qudits # number of qubits/qutrits
         self.circuit = circuit # list of gates in the circuit
         self.qudit = qudit # 2 for qubits, 3 for qutrits
-        self.state = init_state # current state of the system
-        self.clean_state() # remove VERY small amplitudes b/c equivalent to rounding errors
-        self.normalize() # normalize initial state
-        self.remove_global_phase() # make lowest-integer state have real+positive phase
+        self.backend = backend # how the state is stored
+        self.dense_threshold = dense_threshold # fraction of nonzero states at which "auto" goes dense
+        self.validate = validate # when to check normalization
+        self.gate_count = 0 # number of gates applied so far
+        self.memmap_path = memmap_path # file holding the state for the memmap backend
+        self.chunk_size = chunk_size # max number of amplitudes in memory at once for dense states
+        self.hooks = [] # functions called with a GateEvent after each gate in run()
+        if resume:
+            if backend != "memmap": raise Exception("Only the memmap backend can resume from a file")
+            self.state = DenseState(np.memmap(memmap_path, dtype=complex, mode="r+", shape=(qudit**num_qudits,)))
+        else:
+            self.state = init_state # current state of the system
+            self.clean_state() # remove VERY small amplitudes b/c equivalent to rounding errors
+            self.normalize() # normalize initial state
+            self.remove_global_phase() # make lowest-integer state have real+positive phase
+            self.check_density() # switch to a dense vector if requested
         self.trackHistory = trackHistory # bool flag to track history
-        if trackHistory: self.history = [init_state] # used to possibly story history of states
+        if trackHistory: # used to possibly story history of states
+            self.history = History(checkpoint_every, max_history)
+            self.history.append(self.state)
+
+    @property
+    def dense(self):
+        """True if the state is currently stored as a dense vector"""
+        return type(self.state) is DenseState # not isinstance, which is slow for Mapping subclasses
+
+    def to_dense(self):
+        """Switch the current state to a dense vector of length qudit**num_qudits"""
+        if not self.dense:
+            self.state = DenseState(to_vector(self.state, self.qudit**self.num_qudits))
+        return self.state
+
+    def to_memmap(self):
+        """Write the current state to a dense vector in the file at self.memmap_path"""
+        vec = np.memmap(self.memmap_path, dtype=complex, mode="w+", shape=(self.qudit**self.num_qudits,))
+        indices, amps = to_arrays(self.state, len(vec))
+        vec[indices] = amps
+        vec.flush()
+        self.state = DenseState(vec)
+        return self.state
+
+    def check_density(self):
+        """Switch to a dense vector if the backend asks for it"""
+        if self.dense or self.backend == "sparse":
+            return
+        if self.backend == "array":
+            if not isinstance(self.state, SparseState):
+                self.state = SparseState.from_state(self.state, self.qudit**self.num_qudits)
+            return
+        if self.backend == "memmap":
+            self.to_memmap()
+        elif self.backend == "dense" or len(self.state) > self.dense_threshold * self.qudit**self.num_qudits:
+            self.to_dense()
 
     def clean_state(self):
         """Remove zero or low amplitude states that are likely rounding errors\n
         from the current state
         """
+        if self.dense:
+            for start in range(0, len(self.state.vec), self.chunk_size):
+                chunk = self.state.vec[start:start + self.chunk_size]
+                chunk[np.abs(chunk) <= 1e-8] = 0
+            return
+        if type(self.state) is SparseState:
+            amps = self.state.amps
+            keep = amps.real**2 + amps.imag**2 > 1e-16
+            if not keep.all():
+                self.state = SparseState(self.state.indices[keep], amps[keep])
+            return
         for basis_state,amp in list(self.state.items()):
-            if abs(amp) <= 1e-8:
+            if amp.real**2 + amp.imag**2 <= 1e-16:
                 del self.state[basis_state]
     
     def check_normalization(self):
         """Ensure that state is normalized (magnitude is 1)"""
-        mag = 0
-        for amp in self.state.values():
-            mag += abs(amp)**2
+        if self.dense:
+            mag = 0
+            for start in range(0, len(self.state.vec), self.chunk_size):
+                chunk = self.state.vec[start:start + self.chunk_size]
+                mag += np.vdot(chunk, chunk).real
+        elif type(self.state) is SparseState:
+            mag = np.vdot(self.state.amps, self.state.amps).real
+        elif len(self.state) < 64:
+            mag = 0
+            for amp in self.state.values():
+                mag += abs(amp)**2
+        else:
+            amps = np.fromiter(self.state.values(), dtype=complex, count=len(self.state))
+            mag = np.vdot(amps, amps).real
         if abs(1 - mag) > 1e-8:
             raise Exception(f"State is not normalized: {self.state}")
         
@@ -49,174 +146,348 @@ class Simulator:
         new_phase = real_pos_amp / amp_lowest_state
         for basis_state in self.state.keys():
             self.state[basis_state] *= new_phase
-    
-    def run(self):
-        """Run the simulator using self.circuit"""
-        for gate in self.circuit:
-            gate_name, targets = gate.split("-")
-            targets = [int(qi) for qi in targets.split(",")]
-            apply_gate = getattr(self, f"apply_{gate_name}")
-            apply_gate(*targets)
+
+    def update_state(self, new_state, prune=True):
+        """Replace the current state after a gate, then check it (depending on\n
+        self.validate), and record it in the history\n
+        Only dense states still need cleaning with prune=True (see compiler.kernel_args)
+        """
+        self.state = new_state
+        self.gate_count += 1
+        check = self.validate == "gate" or (type(self.validate) is int and self.gate_count % self.validate == 0)
+        if prune and self.dense:
+            self.clean_state()
+        if check:
+            self.check_normalization()
+        self.check_density()
+        if self.trackHistory: self.history.append(self.state)
+        return self.state
+
+    def apply_in_chunks(self, gate_list):
+        """Apply a list of (matrix, targets, controls) gates in place on the memory-mapped\n
+        state, reading and writing each chunk of it once, see kernels.apply_chunked
+        """
+        touched = {q for _,targets,controls in gate_list for q in [*targets, *(qc for qc,_ in controls)]}
+        fixed = chunk_layout(touched, self.num_qudits, self.qudit, self.chunk_size)
+        mag = apply_chunked(self.state.vec, gate_list, fixed, self.num_qudits, self.qudit)
+        self.state.vec.flush()
+        before = self.gate_count
+        self.gate_count += len(gate_list)
+        check = self.validate == "gate" or (type(self.validate) is int and self.gate_count // self.validate > before // self.validate)
+        if check and abs(1 - mag) > 1e-8:
+            raise Exception(f"State is not normalized (magnitude {mag})")
+        return self.state
+
+    def chunk_groups(self, ops):
+        """Split ops into groups of (matrix, targets, controls) gates that can be applied\n
+        together on chunks of at most self.chunk_size amplitudes
+        """
+        group, touched = [], set()
+        for op in ops:
+            matrix, targets, controls = self.gate_matrix(op)
+            qudits = touched | set(targets) | {qc for qc,_ in controls}
+            fixed = chunk_layout(qudits, self.num_qudits, self.qudit, self.chunk_size)
+            if group and self.qudit**(self.num_qudits - len(fixed)) > self.chunk_size:
+                yield group
+                group, qudits = [], set(targets) | {qc for qc,_ in controls}
+            group.append((matrix, targets, controls))
+            touched = qudits
+        if group:
+            yield group
+
+    def gate_matrix(self, op, values={}):
+        """Return the (matrix, targets, controls) of a compiled op\n
+        Parameter names are looked up in values, which may hold arrays of angles
+        """
+        if op.name != "u" and op.name not in gates.GATES: raise Exception(f"Gate {op.name} has no matrix")
+        if op.name != "u" and gates.GATES[op.name][0] != self.qudit: raise Exception(f"Gate {op.name} can't be applied on qudits of size {self.qudit}")
+        controls = op.controls()
+        targets = op.targets[len(controls):]
+        if len(set(op.targets)) != len(op.targets): raise Exception("Control and target qudits need to be unique")
+        return op.matrix(values), targets, controls
+
+    def compile(self, circuit=None, optimize=None):
+        """Compile a circuit (self.circuit by default) into a tuple of Ops\n
+        With optimize=True, runs of single-qudit gates are fused into one matrix and\n
+        self-inverse pairs cancel out. This is the default unless tracking history,\n
+        where every gate in the circuit needs its own time-step
+        """
+        if circuit is None: circuit = self.circuit
+        if optimize is None: optimize = not self.trackHistory
+        return compile_circuit(circuit, self.qudit, type(self), optimize, self.num_qudits)
+
+    def add_hook(self, hook):
+        """Call hook(event) with a profiler.GateEvent after every gate that run() applies\n
+        (every chunk group, named "group", for the memmap backend)\n
+        Counting the nonzero amplitudes costs a pass over a dense state, so hooks slow\n
+        down run(), while no hooks cost nothing
+        """
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def run_hooked(self, step, name, targets, apply, *args):
+        """Apply a gate with apply(*args), timing it and passing a GateEvent to the hooks"""
+        before = len(self.state)
+        start = time.perf_counter()
+        apply(*args)
+        elapsed = time.perf_counter() - start
+        event = GateEvent(step, name, targets, elapsed, before, len(self.state), state_memory(self.state))
+        for hook in self.hooks:
+            hook(event)
+
+    def is_clifford(self):
+        """True if self.circuit only has x, y, z, h, cx and swap gates on qubits"""
+        return self.qudit == 2 and all(op.name in CLIFFORD for op in self.compile(optimize=False))
+
+    def run_stabilizer(self, max_expand=2**20):
+        """Run self.circuit on a stabilizer tableau, in time polynomial in the number of\n
+        qubits, see stabilizer.Tableau. Needs a circuit of only x, y, z, h, cx and swap\n
+        gates, and a basis state as the initial state\n
+        The final state drops the global phase (the smallest basis state gets a real,\n
+        positive amplitude). It becomes the usual dict if it has at most max_expand\n
+        nonzero amplitudes, otherwise a StabilizerState that computes amplitudes on demand\n
+        (and that sample measures without listing them). The tableau is kept in self.tableau
+        """
+        if not self.is_clifford(): raise Exception("The stabilizer mode needs a circuit of only x, y, z, h, cx and swap gates on qubits")
+        if self.trackHistory or self.backend == "memmap": raise Exception("The stabilizer mode can't track history or use the memmap backend")
+        if len(self.state) != 1: raise Exception("The stabilizer mode needs a basis state as the initial state")
+        ops = compile_circuit(self.circuit, self.qudit, Tableau, False, self.num_qudits)
+        self.tableau = Tableau(self.num_qudits, next(iter(self.state)))
+        for op in ops:
+            op.func(self.tableau, *op.args)
+        self.gate_count += len(ops)
+        self.state = StabilizerState(self.tableau)
+        if self.state.rank <= max_expand.bit_length() - 1:
+            self.state = defaultdict(int, zip(*(a.tolist() for a in self.state.to_arrays())))
+            self.check_density()
         return self.state
 
+    def run(self, optimize=None, stabilizer=False):
+        """Run the simulator using self.circuit\n
+        stabilizer=True runs it on a stabilizer tableau instead (see run_stabilizer), which\n
+        drops the global phase. stabilizer="auto" only does so for circuits of only x, y, z,\n
+        h, cx and swap gates on at least STABILIZER_QUBITS qubits, starting from a basis\n
+        state, and not tracking history or with hooks
+        """
+        if stabilizer == "auto":
+            stabilizer = (self.num_qudits >= STABILIZER_QUBITS and not self.trackHistory and not self.hooks
+                          and self.backend != "memmap" and len(self.state) == 1 and self.is_clifford())
+        if stabilizer:
+            return self.run_stabilizer()
+        ops = self.compile(optimize=optimize)
+        if any(op.symbolic for op in ops): raise Exception("Circuit has named parameters, use sweep to give them values")
+        if self.backend == "memmap":
+            for step,group in enumerate(self.chunk_groups(ops)):
+                if self.hooks:
+                    touched = sorted({q for _,targets,controls in group for q in [*targets, *(qc for qc,_ in controls)]})
+                    self.run_hooked(step, "group", tuple(touched), self.apply_in_chunks, group)
+                else:
+                    self.apply_in_chunks(group)
+        elif self.hooks:
+            for step,op in enumerate(ops):
+                self.run_hooked(step, op.name, op.targets, op.func, self, *op.args)
+        else:
+            for op in ops:
+                op.func(self, *op.args)
+        if self.validate != "gate" and self.validate != "never":
+            self.check_normalization()
+        return self.state
+
+    def sweep(self, params):
+        """Run self.circuit from the current state for a whole batch of parameter values\n
+        params maps the parameter names used in the circuit (e.g. "Rx-0;theta") to\n
+        arrays of values, one per sweep point\n
+        Returns a 2-D (batch x basis) array with the final state vector of each sweep point\n
+        Every gate is applied to all sweep points at once, self.state is left unchanged
+        """
+        values = {name: np.asarray(v, dtype=float) for name,v in params.items()}
+        batch = np.broadcast_shapes(*(v.shape for v in values.values()))
+        if len(batch) > 1: raise Exception("Parameter values need to be 1-D arrays")
+        values = {name: np.broadcast_to(v, batch) for name,v in values.items()}
+        vecs = np.tile(to_vector(self.state, self.qudit**self.num_qudits), (batch[0] if batch else 1, 1))
+        for op in self.compile(optimize=True):
+            matrix, targets, controls = self.gate_matrix(op, values)
+            vecs = apply_matrix(vecs, matrix, targets, self.num_qudits, self.qudit, controls)
+        return vecs
+
+    def apply_unitary(self, matrix, targets, controls=(), control_values=None, prune=True):
+        """Apply an arbitrary gate, given by its matrix, on the qudits in targets\n
+        The first target is the least significant digit of the matrix's basis, e.g. for\n
+        qubits and targets [qi, qj], matrix[j, k] is the amplitude of |qj qi> = |j> in gate|k>\n
+        With controls, the gate is only applied where every control qudit is in the state\n
+        given by control_values (all 1 by default)\n
+        prune=False skips cleaning, see compiler.kernel_args
+        """
+        size = self.qudit**len(targets)
+        if control_values is None: control_values = [1] * len(controls)
+        if matrix.shape != (size, size): raise Exception(f"Matrix needs to be {size}x{size}")
+        if len(control_values) != len(controls): raise Exception("Need one control value per control qudit")
+        if not all(0 <= value < self.qudit for value in control_values): raise Exception(f"Control values need to be between 0 and {self.qudit - 1}")
+        qudits = [*targets, *controls]
+        if len(set(qudits)) != len(qudits): raise Exception("Control and target qudits need to be unique")
+        if not all(0 <= q < self.num_qudits for q in qudits): raise Exception(f"Qudits need to be between 0 and {self.num_qudits - 1}")
+        return self.apply_compiled(matrix, targets, tuple(zip(controls, control_values)), prune)
+
+    def apply_compiled(self, matrix, targets, controls=(), prune=True):
+        """Apply a gate matrix on the targets, with controls as (qudit, value) pairs,\n
+        without checking any of it. Used by compiled ops, which were checked when\n
+        compiled, and by apply_unitary after its checks
+        """
+        if self.backend == "memmap":
+            return self.apply_in_chunks([(matrix, targets, controls)])
+        state = self.state
+        if type(state) is DenseState:
+            new_state = DenseState(apply_matrix(state.vec, matrix, targets, self.num_qudits, self.qudit, controls))
+        elif type(state) is SparseState:
+            new_state = SparseState(*apply_arrays(state.indices, state.amps, matrix, targets, self.qudit, controls, prune))
+        else:
+            new_state = apply_sparse(state, matrix, targets, self.qudit, controls, prune)
+        return self.update_state(new_state, prune)
+
+    def apply_u(self, qi, matrix):
+        """Apply an arbitrary single-qudit gate, given by its matrix, on qudit qi\n
+        Used for gates fused by the compiler
+        """
+        return self.apply_unitary(matrix, [qi])
+
+    def check_measured(self, qudits):
+        """Raise if the measured qudits aren't unique qudits of the register"""
+        if len(set(qudits)) != len(qudits): raise Exception("Measured qudits need to be unique")
+        if not all(0 <= q < self.num_qudits for q in qudits): raise Exception(f"Qudits need to be between 0 and {self.num_qudits - 1}")
+
+    def marginalize(self, weights, indices, qudits):
+        """Sum weights (one per basis state in indices) over the outcomes at qudits"""
+        if qudits is None:
+            return indices, weights
+        self.check_measured(qudits)
+        outcomes, inverse = np.unique(marginal_outcomes(indices, qudits, self.qudit), return_inverse=True)
+        return outcomes, np.bincount(inverse.reshape(-1), weights=weights, minlength=len(outcomes))
+
+    def probabilities(self, qudits=None):
+        """Return the probability of each measurement outcome of the given qudits\n
+        (all of them by default) as a dict {outcome: probability}\n
+        Outcomes are the measured digits read as a number in base self.qudit, with\n
+        qudits[0] as the least significant digit\n
+        A StabilizerState's outcomes are read from its tableau, without listing its amplitudes
+        """
+        if isinstance(self.state, StabilizerState):
+            qudits = range(self.num_qudits) if qudits is None else qudits
+            self.check_measured(qudits)
+            outcomes, p = self.state.marginal(qudits)
+            return {outcome: p for outcome in outcomes}
+        indices, amps = to_arrays(self.state, self.qudit**self.num_qudits)
+        outcomes, probs = self.marginalize(np.abs(amps)**2, indices, qudits)
+        return {int(outcome): float(p) for outcome,p in zip(outcomes, probs) if p > 0}
+
+    def sample(self, shots, qudits=None, seed=None):
+        """Measure the given qudits (all of them by default) shots times, without\n
+        changing the state, and return the counts as a dict {outcome: count}\n
+        Outcomes are numbered as in probabilities
+        """
+        if isinstance(self.state, StabilizerState):
+            outcomes, counts = np.unique(self.state.tableau.sample(shots, seed), return_counts=True)
+            outcomes, counts = self.marginalize(counts, outcomes, qudits)
+            return {int(outcome): int(count) for outcome,count in zip(outcomes, counts) if count > 0}
+        indices, amps = to_arrays(self.state, self.qudit**self.num_qudits)
+        cdf = np.cumsum(np.abs(amps)**2)
+        cdf /= cdf[-1]
+        rng = np.random.default_rng(seed)
+        # binary search of each uniform draw in the cumulative probabilities
+        picks = np.searchsorted(cdf, rng.random(shots), side="right")
+        picks = np.minimum(picks, len(cdf) - 1) # guard against rounding at the top end
+        outcomes, counts = self.marginalize(np.bincount(picks, minlength=len(cdf)), indices, qudits)
+        return {int(outcome): int(count) for outcome,count in zip(outcomes, counts) if count > 0}
+
+    def expectation(self, observables, per_term=False):
+        """Return the expectation value sum_k c_k <psi|P_k|psi> of a weighted sum of Pauli\n
+        strings, given as a list of (c_k, P_k) pairs like (0.5, "X0 Z2"), see\n
+        compiler.parse_pauli. For qutrits, P_k are products of clock (Z) and shift (X) gates\n
+        With per_term=True, returns the array of each c_k <psi|P_k|psi> instead\n
+        The state is only read: terms with the same X part share one lookup of the\n
+        amplitudes they pair up, and Z parts become a phase per basis state
+        """
+        terms = [(complex(coeff), *parse_pauli(term, self.qudit)) for coeff,term in observables]
+        if not all(qi < self.num_qudits for _,shift,clock,_ in terms for qi,_ in shift + clock):
+            raise Exception(f"Qudits need to be between 0 and {self.num_qudits - 1}")
+        indices, amps = to_arrays(self.state, self.qudit**self.num_qudits)
+        if not self.dense:
+            order = np.argsort(indices)
+            indices, amps = indices[order], amps[order]
+        groups = defaultdict(list) # X part --> terms with it
+        for k,(_,shift,_,_) in enumerate(terms):
+            groups[shift].append(k)
+        values = np.zeros(len(terms), dtype=complex)
+        for shift,members in groups.items():
+            if not shift:
+                paired = np.abs(amps)**2
+            else:
+                # <psi|P|psi> = sum over b of conj(psi[shifted b]) * phase(b) * psi[b]
+                partners = shift_indices(indices, shift, self.qudit)
+                if self.dense:
+                    other = self.state.vec[partners]
+                else:
+                    pos = np.minimum(np.searchsorted(indices, partners), max(len(indices) - 1, 0))
+                    other = np.where(indices[pos] == partners, amps[pos], 0)
+                paired = np.conj(other) * amps
+            for k in members:
+                coeff, _, clock, factor = terms[k]
+                total = np.sum(paired * clock_phases(indices, clock, self.qudit)) if clock else np.sum(paired)
+                values[k] = coeff * factor * total
+        return values if per_term else complex(values.sum())
+
     def apply_z(self, qi):
         """Apply the Pauli Z gate on qubit qi
         """
         if self.qudit != 2: raise Exception("This gate can only be applied on qubits")
-        new_state = defaultdict(int)
-        for basis_state,amp in self.state.items():
-            # if qi == 1, multiply amplitude by -1
-            if ((basis_state >> qi) & 1):
-                new_state[basis_state] += amp * -1
-            else:
-                new_state[basis_state] += amp
-        self.state = new_state
-        self.clean_state()
-        self.check_normalization()
-        if self.trackHistory: self.history.append(self.state)
-        return self.state
+        return self.apply_unitary(gates.Z, [qi], prune=False)
 
     def apply_x(self, qi):
         """Apply the Pauli X gate on qubit qi
         """
         if self.qudit != 2: raise Exception("This gate can only be applied on qubits")
-        new_state = defaultdict(int)
-        for basis_state,amp in self.state.items():
-            # flip qi 0-->1 and 1-->0
-            new_state[basis_state ^ (1 << qi)] += amp
-        self.state = new_state
-        self.clean_state()
-        self.check_normalization()
-        if self.trackHistory: self.history.append(self.state)
-        return self.state
+        return self.apply_unitary(gates.X, [qi], prune=False)
     
     def apply_y(self, qi):
         """Apply the Pauli Y gate on qubit qi
         """
         if self.qudit != 2: raise Exception("This gate can only be applied on qubits")
-        new_state = defaultdict(int)
-        for basis_state,amp in self.state.items():
-            # flip qi, multiply amplitude by i, also multiply by -1 if starting in |1>
-            if ((basis_state >> qi) & 1):
-                new_state[basis_state ^ (1 << qi)] += amp * -1j
-            else:
-                new_state[basis_state ^ (1 << qi)] += amp * 1j
-        self.state = new_state
-        self.clean_state()
-        self.check_normalization()
-        if self.trackHistory: self.history.append(self.state)
-        return self.state
+        return self.apply_unitary(gates.Y, [qi], prune=False)
 
     def apply_h(self, qi):
         """Apply the Hadamard gate on qubit qi
         """
         if self.qudit != 2: raise Exception("This gate can only be applied on qubits. Did you mean to use h3?")
-        new_state = defaultdict(int)
-        for basis_state,amp in self.state.items():
-            if ((basis_state >> qi) & 1): # if qubit i == 1
-                # |1>  --> 1/sqrt(2)|0> - 1/sqrt(2)|1>
-                new_state[basis_state ^ (1 << qi)] += amp * 1/cmath.sqrt(2)
-                new_state[basis_state] += amp * -1/cmath.sqrt(2)
-            else: # qubit i == 0
-                # |0> --> 1/sqrt(2)|0> + 1/sqrt(2)|1>
-                new_state[basis_state] += amp * 1/cmath.sqrt(2)
-                new_state[basis_state ^ (1 << qi)] += amp * 1/cmath.sqrt(2)
-        self.state = new_state
-        self.clean_state()
-        self.check_normalization()
-        if self.trackHistory: self.history.append(self.state)
-        return self.state
+        return self.apply_unitary(gates.H, [qi])
     
     def apply_phase(self, qi, phi):
         """Apply the phase (P) gate on qubit qi with angle phi"""
         if self.qudit != 2: raise Exception("This gate can only be applied on qubits.")
-        new_state = defaultdict(int)
-        for basis_state,amp in self.state.items():
-            # if qi == 1, multiply amplitude by -1
-            if ((basis_state >> qi) & 1):
-                new_state[basis_state] += amp * cmath.exp(phi*1j)
-            # if qi == 0, no phase added
-            else:
-                new_state[basis_state] += amp
-        self.state = new_state
-        self.clean_state()
-        self.check_normalization()
-        if self.trackHistory: self.history.append(self.state)
-        return self.state
+        return self.apply_unitary(gates.phase(phi), [qi], prune=False)
 
     def apply_Rx(self, qi, theta):
         """Apply the Rx (Rotation around X) gate on qubit qi with angle theta"""
         if self.qudit != 2: raise Exception("This gate can only be applied on qubits.")
-        new_state = defaultdict(int)
-        for basis_state,amp in self.state.items():
-            if ((basis_state >> qi) & 1): # if qubit i == 1
-                # |1>  --> -isin(theta/2)|0> + cos(theta/2)|1>
-                new_state[basis_state ^ (1 << qi)] += amp * cmath.sin(theta/2) * -1j
-                new_state[basis_state] += amp * cmath.cos(theta/2)
-            else: # qubit i == 0
-                # |0> --> cos(theta/2)|0> -isin(theta/2)|1>
-                new_state[basis_state] += amp * cmath.cos(theta/2)
-                new_state[basis_state ^ (1 << qi)] += amp * cmath.sin(theta/2) * -1j
-        self.state = new_state
-        self.clean_state()
-        self.check_normalization()
-        if self.trackHistory: self.history.append(self.state)
-        return self.state
+        return self.apply_unitary(gates.Rx(theta), [qi])
     
     def apply_Ry(self, qi, theta):
         """Apply the Ry (Rotation around Y) gate on qubit qi with angle theta"""
         if self.qudit != 2: raise Exception("This gate can only be applied on qubits.")
-        new_state = defaultdict(int)
-        for basis_state,amp in self.state.items():
-            if ((basis_state >> qi) & 1): # if qubit i == 1
-                # |1>  --> -sin(theta/2)|0> + cos(theta/2)|1>
-                new_state[basis_state ^ (1 << qi)] += amp * -1 * cmath.sin(theta/2)
-                new_state[basis_state] += amp * cmath.cos(theta/2)
-            else: # qubit i == 0
-                # |0> --> cos(theta/2)|0> + sin(theta/2)|1>
-                new_state[basis_state] += amp * cmath.cos(theta/2)
-                new_state[basis_state ^ (1 << qi)] += amp * cmath.sin(theta/2)
-        self.state = new_state
-        self.clean_state()
-        self.check_normalization()
-        if self.trackHistory: self.history.append(self.state)
-        return self.state
+        return self.apply_unitary(gates.Ry(theta), [qi])
     
     def apply_Rz(self, qi, theta):
         """Apply the Rz (Rotation around Z) gate on qubit qi with angle theta"""
         if self.qudit != 2: raise Exception("This gate can only be applied on qubits.")
-        new_state = defaultdict(int)
-        for basis_state,amp in self.state.items():
-            if ((basis_state >> qi) & 1): # if qubit i == 1
-                # |1>  --> exp(itheta/2)|1>
-                new_state[basis_state] += amp * cmath.exp(1j * theta / 2)
-            else: # qubit i == 0
-                # |0> --> exp(-itheta/2)|0>
-                new_state[basis_state] += amp * cmath.exp(-1j * theta / 2)
-        self.state = new_state
-        self.clean_state()
-        self.check_normalization()
-        if self.trackHistory: self.history.append(self.state)
-        return self.state
+        return self.apply_unitary(gates.Rz(theta), [qi], prune=False)
 
     def apply_swap(self, qi, qj):
         """Apply the Swap gate, with target qubits qi and qj
         """
         if self.qudit != 2: raise Exception("This gate can only be applied on qubits. Did you mean to use swap3?")
         if qi == qj: raise Exception("Target qubits need to be unique")
-        new_state = defaultdict(int)
-        for basis_state,amp in self.state.items():
-            i = (basis_state >> qi) & 1 # state of qi
-            j = (basis_state >> qj) & 1 # state of qj
-            # following XORs set the states to 0 for qi,qj, and then place the swapped values
-            #    at those qubits
-            new_basis_state = basis_state ^ (i << qi) ^ (j << qj) ^ (i << qj) ^ (j << qi)
-            new_state[new_basis_state] += amp
-        self.state = new_state
-        self.clean_state()
-        self.check_normalization()
-        if self.trackHistory: self.history.append(self.state)
-        return self.state
+        return self.apply_unitary(gates.SWAP, [qi, qj], prune=False)
     
     def apply_cx(self, qc, qi):
         """Apply the Controlled X / Controlled Not gate, with control qubit qc,\n
@@ -224,17 +495,7 @@ class Simulator:
         """
         if self.qudit != 2: raise Exception("This gate can only be applied on qubits")
         if qc == qi: raise Exception("Control and target qubits need to be unique")
-        new_state = defaultdict(int)
-        for basis_state,amp in self.state.items():
-            if ((basis_state >> qc) & 1): # if qubit c == 1, flip qubit i
-                new_state[basis_state ^ (1 << qi)] += amp
-            else: # qubit c == 0, no change
-                new_state[basis_state] += amp
-        self.state = new_state
-        self.clean_state()
-        self.check_normalization()
-        if self.trackHistory: self.history.append(self.state)
-        return self.state
+        return self.apply_unitary(gates.X, [qi], controls=[qc], prune=False)
     
     def apply_cswap(self, qc, qi, qj):
         """Apply the Controlled Swap gate, with control qubit qc, and target\n
@@ -242,22 +503,7 @@ class Simulator:
         """
         if self.qudit != 2: raise Exception("This gate can only be applied on qubits. Did you mean to use cswap3?")
         if len({qc, qi, qj}) != 3: raise Exception("Control and target qubits need to be unique")
-        new_state = defaultdict(int)
-        for basis_state,amp in self.state.items():
-            if ((basis_state >> qc) & 1): # if qubit c == 1, swap qubits i and j
-                i = (basis_state >> qi) & 1 # state of qi
-                j = (basis_state >> qj) & 1 # state of qj
-                # following XORs set the states to 0 for qi,qj, and then place the swapped values
-                #    at those qubits
-                new_basis_state = basis_state ^ (i << qi) ^ (j << qj) ^ (i << qj) ^ (j << qi)
-                new_state[new_basis_state] += amp
-            else: # qubit c == 0, no swap
-                new_state[basis_state] += amp
-        self.state = new_state
-        self.clean_state()
-        self.check_normalization()
-        if self.trackHistory: self.history.append(self.state)
-        return self.state
+        return self.apply_unitary(gates.SWAP, [qi, qj], controls=[qc], prune=False)
     
     def apply_ccx(self, qc1, qc2, qi):
         """Apply the Double Controlled  X / Not gate, with control qubits qc1\n
@@ -265,63 +511,30 @@ class Simulator:
         """
         if self.qudit != 2: raise Exception("This gate can only be applied on qubits")
         if len({qc1, qc2, qi}) != 3: raise Exception("Control and target qubits need to be unique")
-        new_state = defaultdict(int)
-        for basis_state,amp in self.state.items():
-            if ((basis_state >> qc1) & 1) and ((basis_state >> qc2) & 1): # if both controls
-                new_state[basis_state ^ (1 << qi)] += amp
-            else: # one of the controls is 0, no change
-                new_state[basis_state] += amp
-        self.state = new_state
-        self.clean_state()
-        self.check_normalization()
-        if self.trackHistory: self.history.append(self.state)
-        return self.state
+        return self.apply_unitary(gates.X, [qi], controls=[qc1, qc2], prune=False)
     
-    def apply_controlled(self, gate_name, qc, qi, *args):
-        """Apply an arbitrary Controlled gate on qubits\n
-        Supports an arbitrary number of control qubits qc, and the correct number\n
-        of qubits for the given gate as targets in qi\n
-        Use *args for values like theta/phi for rotation gates"""
-        if self.qudit != 2: raise Exception("This gate can only be applied on qubits")
-        if len(set(qc).add(set(qi))) != len(qc) + len(qi): raise Exception("Control and target qubits need to be unique")
-        new_state = defaultdict(int)
-        for basis_state,amp in self.state.items():
-            if all(((basis_state >> q) & 1) for q in qc): # check all control qubits are 1
-                apply_gate = getattr(self, f"apply_{gate_name}")
-                apply_gate(*qi, *args)
-            else: # one of the controls is 0, no change
-                new_state[basis_state] += amp
-        self.state = new_state
-        self.clean_state()
-        self.check_normalization()
-        if self.trackHistory: self.history.append(self.state)
-        return self.state
+    def apply_controlled(self, gate_name, qc, qi, *args, control_values=None):
+        """Apply an arbitrary Controlled gate\n
+        Supports an arbitrary number of control qudits qc, and the correct number\n
+        of qudits for the given gate as targets in qi (a single int works for either)\n
+        Use *args for values like theta/phi for rotation gates\n
+        The gate is applied where every control is in the state given by control_values\n
+        (all 1 by default), in a single pass over the state"""
+        if gate_name not in gates.GATES: raise Exception(f"Unknown gate: {gate_name}")
+        qudit, num_controls, num_targets, matrix = gates.GATES[gate_name]
+        if self.qudit != qudit: raise Exception(f"Gate {gate_name} can't be applied on qudits of size {self.qudit}")
+        qc = [qc] if isinstance(qc, int) else list(qc)
+        qi = [qi] if isinstance(qi, int) else list(qi)
+        if len(qi) != num_controls + num_targets: raise Exception(f"Gate {gate_name} needs {num_controls + num_targets} qudits")
+        if control_values is None: control_values = [1] * len(qc)
+        # the gate's own controls (like the control of cx) are controls too
+        return self.apply_unitary(matrix(*args), qi[num_controls:], controls=[*qc, *qi[:num_controls]],
+                                  control_values=[*control_values, *[1] * num_controls])
 
     def apply_h3(self, qi):
         """Apply the Hadamard gate to qutrit qi"""
         if self.qudit != 3: raise Exception("This gate can only be applied on qutrits. Did you mean to use h?")
-        new_state = defaultdict(int)
-        for basis_state,amp in self.state.items():
-            if ((basis_state // 3**qi) % 3) == 0: # qutrit i == 0
-                # |0>  --> 1/sqrt(3)|0> + 1/sqrt(3)|1> + 1/sqrt(3)|2>
-                new_state[basis_state] += amp * 1/cmath.sqrt(3)
-                new_state[basis_state + 3**qi] += amp * 1/cmath.sqrt(3)
-                new_state[basis_state + 2*3**qi] += amp * 1/cmath.sqrt(3)
-            elif ((basis_state // 3**qi) % 3) == 1: # qutrit i == 1
-                # |1> --> 1/sqrt(3)|0> + e^(i*2pi/3)/sqrt(3)|1> + e^(i*4pi/3)/sqrt(3)|2>
-                new_state[basis_state - 3**qi] += amp * 1/cmath.sqrt(3)
-                new_state[basis_state] += amp * (-0.5 + 1j*cmath.sqrt(3)/2)/cmath.sqrt(3)
-                new_state[basis_state + 3**qi] += amp * (-0.5 - 1j*cmath.sqrt(3)/2)/cmath.sqrt(3)
-            else: # qutrit i == 2
-                # |2> --> 1/sqrt(3)|0> + e^(i*4pi/3)/sqrt(3)|1> + e^(i*2pi/3)/sqrt(3)|2>
-                new_state[basis_state - 2*3**qi] += amp * 1/cmath.sqrt(3)
-                new_state[basis_state - 3**qi] += amp * (-0.5 - 1j*cmath.sqrt(3)/2)/cmath.sqrt(3)
-                new_state[basis_state] += amp * (-0.5 + 1j*cmath.sqrt(3)/2)/cmath.sqrt(3)
-        self.state = new_state
-        self.clean_state()
-        self.check_normalization()
-        if self.trackHistory: self.history.append(self.state)
-        return self.state
+        return self.apply_unitary(gates.H3, [qi])
     
     def apply_cswap3(self, qc, qi, qj):
         """Apply the Controlled Swap gate, with control qutrit qc, and target
@@ -329,19 +542,4 @@ class Simulator:
         """
         if self.qudit != 3: raise Exception("This gate can only be applied on qutrits. Did you mean to use cswap?")
         if len({qc, qi, qj}) != 3: raise Exception("Control and target qutrits need to be unique")
-        new_state = defaultdict(int)
-        for basis_state,amp in self.state.items():
-            if ((basis_state // 3**qc) % 3) == 1: # if qutrit c == 1, swap i and j
-                i = (basis_state // 3**qi) % 3
-                j = (basis_state // 3**qj) % 3
-                # Just as with the qubit swap, we set the states at qi,qj to 0, and
-                #     then add in the swapped values
-                new_basis_state = basis_state - i*3**qi - j*3**qj + i*3**qj + j*3**qi
-                new_state[new_basis_state] += amp
-            else: # qutrit c == 0 or 2, no swap
-                new_state[basis_state] += amp
-        self.state = new_state
-        self.clean_state()
-        self.check_normalization()
-        if self.trackHistory: self.history.append(self.state)
-        return self.state
\ No newline at end of file
+        return self.apply_unitary(gates.SWAP3, [qi, qj], controls=[qc], prune=False)
@@ -0,0 +1,204 @@
+from collections.abc import Mapping
+import numpy as np
+from kernels import parity
+
+# gates the tableau can apply, see Tableau
+CLIFFORD = {"x", "y", "z", "h", "cx", "swap"}
+
+# Simulator.run(stabilizer="auto") only switches to the tableau from this many qubits on,
+# since smaller circuits are cheap enough on the usual backends
+STABILIZER_QUBITS = 24
+
+def product(row1, row2):
+    """Product of two Pauli rows (x bits, z bits, sign bit), i.e. the generator row1 * row2"""
+    x1, z1, r1 = row1
+    x2, z2, r2 = row2
+    # powers of i picked up on each qubit: X*Y, Y*Z, Z*X give +i, the reverse orders -i
+    x1_only, z1_only, y1 = x1 & ~z1, z1 & ~x1, x1 & z1
+    x2_only, z2_only, y2 = x2 & ~z2, z2 & ~x2, x2 & z2
+    plus = (x1_only & y2) | (y1 & z2_only) | (z1_only & x2_only)
+    minus = (x1_only & z2_only) | (y1 & x2_only) | (z1_only & y2)
+    power = (2*r1 + 2*r2 + bin(plus).count("1") - bin(minus).count("1")) % 4
+    return x1 ^ x2, z1 ^ z2, power // 2
+
+class Tableau:
+    """Stabilizer tableau of an n-qubit state, for circuits of x, y, z, h, cx and swap gates\n
+    The state is the one stabilized by n commuting Pauli strings (generators), each a\n
+    sign and an X and Z bit per qubit (both set for Y). The bits are packed by qubit:\n
+    bit i of x[q] and z[q] is the X and Z part on qubit q of generator i, and bit i of r\n
+    is its sign, so every gate is a few bitwise operations on whole columns
+    """
+    def __init__(self, num_qubits, basis_state=0):
+        self.num_qubits = num_qubits
+        # |b> is stabilized by (-1)^(b_q) Z_q for each qubit q
+        self.x = [0] * num_qubits
+        self.z = [1 << q for q in range(num_qubits)]
+        self.r = basis_state
+
+    def apply_x(self, qi):
+        self.r ^= self.z[qi]
+
+    def apply_y(self, qi):
+        self.r ^= self.x[qi] ^ self.z[qi]
+
+    def apply_z(self, qi):
+        self.r ^= self.x[qi]
+
+    def apply_h(self, qi):
+        self.r ^= self.x[qi] & self.z[qi]
+        self.x[qi], self.z[qi] = self.z[qi], self.x[qi]
+
+    def apply_cx(self, qc, qi):
+        if qc == qi: raise Exception("Control and target qubits need to be unique")
+        x, z = self.x, self.z
+        self.r ^= x[qc] & z[qi] & ~(x[qi] ^ z[qc])
+        x[qi] ^= x[qc]
+        z[qc] ^= z[qi]
+
+    def apply_swap(self, qi, qj):
+        if qi == qj: raise Exception("Swapped qubits need to be unique")
+        self.x[qi], self.x[qj] = self.x[qj], self.x[qi]
+        self.z[qi], self.z[qj] = self.z[qj], self.z[qi]
+
+    def generators(self):
+        """The generators as a list of (x bits, z bits, sign bit) rows"""
+        n = self.num_qubits
+        xs, zs = [0] * n, [0] * n
+        for bits,columns in ((xs, self.x), (zs, self.z)):
+            for q,column in enumerate(columns):
+                while column:
+                    low = column & -column
+                    bits[low.bit_length() - 1] |= 1 << q
+                    column ^= low
+        return [(xs[i], zs[i], (self.r >> i) & 1) for i in range(n)]
+
+    def support(self):
+        """Return (b0, rows): the nonzero amplitudes of the state are on the basis states\n
+        b0 ^ (any combination of the x bits of rows), 2**len(rows) of them\n
+        Each row is a generator with a distinct highest X bit, and b0 is the smallest\n
+        basis state of the support
+        """
+        rows = self.generators()
+        k = 0
+        for q in reversed(range(self.num_qubits)):
+            pivot = next((i for i in range(k, len(rows)) if rows[i][0] >> q & 1), None)
+            if pivot is None:
+                continue
+            rows[k], rows[pivot] = rows[pivot], rows[k]
+            for i in range(len(rows)):
+                if i != k and rows[i][0] >> q & 1:
+                    rows[i] = product(rows[i], rows[k])
+            k += 1
+        # the rest only have Z parts: the support is where parity(z & b) == sign for them all
+        constraints = [(z, r) for _,z,r in rows[k:]]
+        echelon = [] # (highest bit, z, sign) of each independent constraint
+        for q in reversed(range(self.num_qubits)):
+            pivot = next((i for i,(z,_) in enumerate(constraints) if z >> q & 1), None)
+            if pivot is None:
+                continue
+            z, r = constraints.pop(pivot)
+            constraints = [(z2 ^ z, r2 ^ r) if z2 >> q & 1 else (z2, r2) for z2,r2 in constraints]
+            echelon.append((q, z, r))
+        # back substitution from the lowest bit, other bits are free and left at 0
+        b0 = 0
+        for q,z,r in reversed(echelon):
+            b0 |= (r ^ bin(b0 & z).count("1") & 1) << q
+        gens = rows[:k]
+        # smallest basis state: clear the highest bits first
+        for x,_,_ in gens:
+            if b0 >> (x.bit_length() - 1) & 1:
+                b0 ^= x
+        return b0, gens
+
+    def sample(self, shots, seed=None):
+        """Measure all qubits shots times, returning the measured basis states\n
+        (each basis state of the support is equally likely)
+        """
+        b0, gens = self.support()
+        dtype = np.int64 if self.num_qubits <= 63 else object
+        rng = np.random.default_rng(seed)
+        out = np.full(shots, b0, dtype=dtype)
+        for x,_,_ in gens:
+            out[rng.random(shots) < 0.5] ^= x
+        return out
+
+class StabilizerState(Mapping):
+    """Read-only dictionary view of the state of a Tableau, like DenseState\n
+    Amplitudes are computed from the generators when asked for, so the 2**rank nonzero\n
+    basis states are never all held in memory. The global phase makes the smallest\n
+    basis state's amplitude real and positive
+    """
+    def __init__(self, tableau):
+        self.tableau = tableau
+        self.b0, self.gens = tableau.support()
+        self.rank = len(self.gens) # log2 of the number of nonzero amplitudes
+        # each generator maps the amplitude at b to the one at b ^ x, times a phase
+        self.factors = [(-1)**r * 1j**bin(x & z).count("1") for x,z,r in self.gens]
+
+    def __getitem__(self, basis_state):
+        if basis_state not in self:
+            return 0
+        amp = 2**(-self.rank / 2)
+        current = self.b0
+        for (x,z,_),factor in zip(self.gens, self.factors):
+            if (basis_state ^ current) >> (x.bit_length() - 1) & 1:
+                amp *= factor * (-1)**bin(current & z).count("1")
+                current ^= x
+        return amp
+
+    def __contains__(self, basis_state):
+        if not 0 <= basis_state < 2**self.tableau.num_qubits:
+            return False
+        diff = basis_state ^ self.b0
+        for x,_,_ in self.gens:
+            if diff >> (x.bit_length() - 1) & 1:
+                diff ^= x
+        return diff == 0
+
+    def __iter__(self):
+        # Gray code order, one generator flip per basis state
+        current = self.b0
+        yield current
+        for i in range(1, 2**self.rank):
+            current ^= self.gens[(i & -i).bit_length() - 1][0]
+            yield current
+
+    def __len__(self):
+        return 2**self.rank
+
+    def marginal(self, qubits):
+        """Outcomes of measuring the given qubits (qubits[0] least significant), which are\n
+        all equally likely: the bits at qubits of b0 ^ (any combination of the x bits of\n
+        the generators). Returns (list of outcomes, probability of each)
+        """
+        def project(b):
+            return sum(((b >> q) & 1) << j for j,q in enumerate(qubits))
+        # basis of the projected x bits over GF(2), one per highest bit, highest first
+        basis = []
+        for x,_,_ in self.gens:
+            v = project(x)
+            for u in basis:
+                v = min(v, v ^ u)
+            if v:
+                basis.append(v)
+                basis.sort(reverse=True)
+        outcomes = [project(self.b0)]
+        for u in basis:
+            outcomes += [outcome ^ u for outcome in outcomes]
+        return outcomes, 2.0**-len(basis)
+
+    def to_arrays(self):
+        """All nonzero basis states and amplitudes as two numpy arrays, built by doubling\n
+        the support once per generator
+        """
+        dtype = np.int64 if self.tableau.num_qubits <= 63 else object
+        indices = np.array([self.b0], dtype=dtype)
+        amps = np.array([2**(-self.rank / 2)], dtype=complex)
+        for (x,z,_),factor in zip(self.gens, self.factors):
+            signs = 1 - 2 * parity(indices & z)
+            indices = np.concatenate([indices, indices ^ x])
+            amps = np.concatenate([amps, amps * factor * signs])
+        return indices, amps
+
+    def __repr__(self):
+        return f"StabilizerState(rank {self.rank}, smallest basis state {self.b0})"
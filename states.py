@@ -0,0 +1,115 @@
+from collections.abc import Mapping
+import numpy as np
+
+class DenseState(Mapping):
+    """Read-only dictionary view of a dense state vector\n
+    Behaves like the sparse {basis_state: amplitude} dict: iterating gives the\n
+    nonzero basis states, and missing basis states have amplitude 0
+    """
+    def __init__(self, vec):
+        self.vec = vec # complex128 array of length qudit**num_qudits
+
+    def __getitem__(self, basis_state):
+        if not 0 <= basis_state < len(self.vec):
+            return 0 # like a missing key of the sparse dict, and not numpy's negative indexing
+        return complex(self.vec[basis_state])
+
+    def __contains__(self, basis_state):
+        return 0 <= basis_state < len(self.vec) and self.vec[basis_state] != 0
+
+    def __iter__(self):
+        return iter(np.flatnonzero(self.vec).tolist())
+
+    def __len__(self):
+        return int(np.count_nonzero(self.vec))
+
+    def __repr__(self):
+        return f"DenseState({dict(self.items())})"
+
+class SparseState(Mapping):
+    """Read-only dictionary view of a sparse state kept as two numpy arrays: the sorted\n
+    int64 basis states with a nonzero amplitude, and their complex128 amplitudes\n
+    About 24 bytes per amplitude, against 100+ for a dict entry
+    """
+    def __init__(self, indices, amps):
+        self.indices = indices # sorted, unique int64 basis states
+        self.amps = amps # complex128 amplitude of each
+
+    @classmethod
+    def from_state(cls, state, dim):
+        """Convert any state to a SparseState (needs dim <= 2**63)"""
+        if dim > 2**63: raise Exception("Array states need qudit**num_qudits <= 2**63")
+        indices, amps = to_arrays(state, dim)
+        order = np.argsort(indices, kind="stable")
+        return cls(indices[order], amps[order])
+
+    def positions(self, basis_states):
+        """Position of each basis state in self.indices, and whether it is there at all"""
+        pos = np.minimum(np.searchsorted(self.indices, basis_states), max(len(self.indices) - 1, 0))
+        return pos, self.indices[pos] == basis_states if len(self.indices) else np.zeros(np.shape(basis_states), dtype=bool)
+
+    def lookup(self, basis_states):
+        """Amplitudes of an array of basis states, 0 for the missing ones"""
+        pos, found = self.positions(basis_states)
+        return np.where(found, self.amps[pos] if len(self.amps) else 0, 0)
+
+    def __getitem__(self, basis_state):
+        i = np.searchsorted(self.indices, basis_state)
+        if i < len(self.indices) and self.indices[i] == basis_state:
+            return complex(self.amps[i])
+        return 0
+
+    def __contains__(self, basis_state):
+        i = np.searchsorted(self.indices, basis_state)
+        return bool(i < len(self.indices) and self.indices[i] == basis_state)
+
+    def __iter__(self):
+        return iter(self.indices.tolist())
+
+    def __len__(self):
+        return len(self.indices)
+
+    def items(self):
+        return zip(self.indices.tolist(), self.amps.tolist())
+
+    def values(self):
+        return self.amps.tolist()
+
+    def __repr__(self):
+        return f"SparseState({dict(self.items())})"
+
+def to_vector(state, dim):
+    """Return the amplitudes of a state as a dense complex128 vector of length dim"""
+    if isinstance(state, DenseState):
+        return state.vec.copy()
+    vec = np.zeros(dim, dtype=complex)
+    if isinstance(state, SparseState):
+        vec[state.indices] = state.amps
+        return vec
+    if state:
+        vec[np.fromiter(state.keys(), dtype=np.int64, count=len(state))] = list(state.values())
+    return vec
+
+def to_arrays(state, dim):
+    """Return the nonzero basis states and their amplitudes as two numpy arrays\n
+    Basis states are int64, unless they don't fit (dim > 2**63) and stay Python ints\n
+    The arrays of a SparseState are returned as they are, so don't change them
+    """
+    if isinstance(state, DenseState):
+        indices = np.flatnonzero(state.vec)
+        return indices, state.vec[indices]
+    if isinstance(state, SparseState):
+        return state.indices, state.amps
+    dtype = np.int64 if dim <= 2**63 else object
+    indices = np.fromiter(state.keys(), dtype=dtype, count=len(state))
+    amps = np.fromiter(state.values(), dtype=complex, count=len(state))
+    return indices, amps
+
+def marginal_outcomes(indices, qudits, qudit):
+    """Digits of each basis state at the given qudits, read as a number in base qudit\n
+    with qudits[0] as the least significant digit
+    """
+    outcomes = np.zeros(len(indices), dtype=indices.dtype)
+    for j,qi in enumerate(qudits):
+        outcomes += (indices // qudit**qi) % qudit * qudit**j
+    return outcomes
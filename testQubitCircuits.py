@@ -1,7 +1,18 @@
 import unittest
+import asyncio
 import cmath
+import io
+import os
+import tempfile
 from simulator import Simulator
+import gates
+from sharded import ShardedSimulator
 from helper import *
+import benchmark
+from profiler import Profiler
+from qasm import parse_qasm, load_qasm
+from stabilizer import StabilizerState
+from batch import run_batch, run_batch_async
 
 class TestQubitCircuits(unittest.TestCase):
     def test_entanglement(self):
@@ -23,6 +34,283 @@ class TestQubitCircuits(unittest.TestCase):
         # final state checked with https://algassert.com/quirk
         for i in [396, 399, 412, 415, 428, 431, 476, 479]:
             self.assertAlmostEqual(sim.state[i], -1j/cmath.sqrt(8))
+
+    def test_validation_modes(self):
+        circuit = ["h-0", "cx-0,1", "y-2", "x-3", "h-4", "h-5", "cswap-4,5,6", "x-7", "x-8", "z-8"]
+        for validate in ["gate", 3, "end", "never"]:
+            sim = Simulator(10, qudit=2, circuit=circuit, init_state={0: 1}, validate=validate)
+            sim.run()
+            self.assertAlmostEqual(sim.state[396], -1j/cmath.sqrt(8))
+        # a broken state is caught at the end of run(), but not with "never"
+        sim = Simulator(2, qudit=2, circuit=["h-0", "x-1"], init_state={0: 1}, validate="end")
+        sim.apply_h(0)
+        sim.state[3] = 1
+        self.assertRaises(Exception, sim.run)
+        with self.assertRaises(Exception):
+            Simulator(2, qudit=2, validate="sometimes")
+        with self.assertRaises(Exception):
+            Simulator(2, qudit=2, validate=True)
+        # rounding errors are dropped by the kernels, even without validation
+        for backend in ["sparse", "array"]:
+            sim = Simulator(3, qudit=2, circuit=["h-0", "h-1", "cx-1,2", "Rx-0;0.3", "Rx-0;-0.3", "cx-1,2", "h-1", "h-0"],
+                            init_state={0: 1}, backend=backend, validate="never")
+            sim.run(optimize=False)
+            self.assertEqual(list(sim.state), [0])
+
+    def test_read_missing_amplitude(self):
+        # reading a missing basis state inserts a 0 into the dict, which gates leave out
+        sim = Simulator(2, qudit=2, circuit=["h-0"], init_state={0: 1})
+        sim.run()
+        self.assertEqual(sim.state[2], 0)
+        sim.apply_x(1)
+        self.assertEqual(len(sim.state), 2)
+        out = io.StringIO()
+        print_sim(sim, f=out)
+        self.assertEqual(out.getvalue(), "|Psi> = 0.7071|10> + 0.7071|11>\n")
+
+    def test_sharded(self):
+        circuit = ["h-0", "cx-0,1", "y-2", "x-3", "h-4", "h-5", "cswap-4,5,6", "x-7", "x-8", "z-8", "cx-9,2", "swap-8,1"]
+        sim = Simulator(10, qudit=2, circuit=circuit, init_state={2**9: 1})
+        sim.run()
+        sharded = ShardedSimulator(10, qudit=2, circuit=circuit, init_state={2**9: 1}, shard_qudits=2)
+        sharded.run()
+        # cx-9,2 only has a sharded control, swap-8,1 needs an exchange
+        self.assertEqual(sharded.exchanges, 1)
+        for i in range(2**10):
+            self.assertAlmostEqual(sim.state[i], sharded.state[i])
+        self.assertRaises(Exception, ShardedSimulator(4, qudit=2, circuit=["h-7"]).run)
+
+    def test_dense_backend(self):
+        circuit = ["h-0", "cx-0,1", "y-2", "x-3", "h-4", "h-5", "cswap-4,5,6", "x-7", "x-8", "z-8"]
+        sparse = Simulator(10, qudit=2, circuit=circuit, init_state={0: 1})
+        dense = Simulator(10, qudit=2, circuit=circuit, init_state={0: 1}, backend="dense")
+        sparse.run()
+        dense.run()
+        self.assertTrue(dense.dense)
+        for i in range(2**10):
+            self.assertAlmostEqual(sparse.state[i], dense.state[i])
+        # basis states outside the register read as 0, like missing keys of the dict
+        for i in (-1, 2**10):
+            self.assertEqual(dense.state[i], 0)
+            self.assertNotIn(i, dense.state)
+
+    def test_compile(self):
+        sim = Simulator(3, qudit=2, circuit=["h-0", "h-0", "cx-0,1", "x-2", "cx-0,1", "h-1", "z-1", "h-1"], init_state={0: 1})
+        # h-0,h-0 and the two cx cancel, h,z,h on qubit 1 fuse into one matrix (= x)
+        ops = sim.compile()
+        self.assertEqual([(op.name, op.targets) for op in ops], [("x", (2,)), ("u", (1,))])
+        sim.run()
+        self.assertAlmostEqual(sim.state[6], 1)
+        # invalid gates raise even when they would cancel out
+        for circuit in (["cx-0,0", "cx-0,0"], ["x-7", "x-7"], ["h3-0", "h3-0"]):
+            self.assertRaises(Exception, Simulator(2, qudit=2, circuit=circuit).run)
+
+    def test_controlled(self):
+        sim = Simulator(5, qudit=2, circuit=["h-0", "h-1", "h-2", "x-3"], init_state={0: 1})
+        sim.run()
+        ref = Simulator(5, qudit=2, circuit=["h-0", "h-1", "h-2", "x-3", "ccx-0,1,4"], init_state={0: 1})
+        ref.run()
+        # Toffoli as a 2-controlled x
+        sim.apply_controlled("x", [0, 1], 4)
+        self.assertEqual(dict(sim.state), dict(ref.state))
+        # 3 controls on a cx is a 4-controlled x, only |11111> and |01111> swap
+        sim.apply_controlled("cx", [0, 1, 2], [3, 4])
+        self.assertAlmostEqual(sim.state[0b01111], 1/cmath.sqrt(8))
+        self.assertAlmostEqual(sim.state[0b11111], 0)
+        # parametric gate, controlled on qubit 2 being 0
+        sim.apply_controlled("Ry", 2, 4, cmath.pi, control_values=[0])
+        self.assertAlmostEqual(sim.state[0b11000], 1/cmath.sqrt(8))
+        self.assertRaises(Exception, sim.apply_controlled, "x", [0, 1], 1)
+
+    def test_sweep(self):
+        thetas = [0, cmath.pi/2, cmath.pi, 3*cmath.pi/2]
+        sim = Simulator(2, qudit=2, circuit=["Ry-0;theta", "cx-0,1", "Rz-1;0.5"], init_state={0: 1})
+        states = sim.sweep({"theta": thetas})
+        self.assertEqual(states.shape, (4, 4))
+        for theta,state in zip(thetas, states):
+            single = Simulator(2, qudit=2, init_state={0: 1})
+            single.apply_Ry(0, theta)
+            single.apply_cx(0, 1)
+            single.apply_Rz(1, 0.5)
+            for i in range(4):
+                self.assertAlmostEqual(single.state[i], state[i])
+
+    def test_benchmark(self):
+        # QFT of |k> has amplitudes e^(2 pi i k j / N) / sqrt(N)
+        sim = Simulator(3, qudit=2, circuit=benchmark.qft(3), init_state={3: 1})
+        sim.run()
+        for j in range(8):
+            self.assertAlmostEqual(sim.state[j], cmath.exp(2j*cmath.pi*3*j/8) / cmath.sqrt(8))
+        # 1 + 2 on the adder's 2-bit registers
+        sim = Simulator(7, qudit=2, circuit=benchmark.toffoli_adder(7), init_state={0: 1})
+        sim.run()
+        self.assertEqual(list(sim.state), [1 + (3 << 2)])
+        old = {"results": [benchmark.run_case("ghz", 4, 1.0, "sparse", repeat=1)]}
+        new = {"results": [dict(old["results"][0], wall_time=old["results"][0]["wall_time"] + 1)]}
+        self.assertEqual(benchmark.compare(old, old), [])
+        self.assertEqual([metric for _,metric,_,_ in benchmark.compare(old, new)], ["wall_time"])
+        # denser preparations never give sparser states, and nonzero follows the circuit's gates
+        for family in ("ghz", "qutrit"):
+            results = [benchmark.run_case(family, 6, density, "sparse", repeat=1) for density in (0.0, 0.5, 1.0)]
+            self.assertEqual([r["max_nonzero"] for r in results], sorted(r["max_nonzero"] for r in results))
+            self.assertEqual(results[-1]["max_nonzero"], benchmark.FAMILIES[family][0]**6)
+            self.assertEqual(len(results[-1]["nonzero"]), results[-1]["gates"] + 1)
+
+    def test_profiler(self):
+        sim = Simulator(4, qudit=2, circuit=["h-0", "h-1", "cx-1,2", "h-3", "cx-0,1"], init_state={0: 1})
+        profiler = sim.add_hook(Profiler())
+        events = []
+        sim.add_hook(events.append)
+        sim.run(optimize=False)
+        self.assertEqual([(e.name, e.targets) for e in events], [("h", (0,)), ("h", (1,)), ("cx", (1, 2)), ("h", (3,)), ("cx", (0, 1))])
+        self.assertEqual([e.nonzero_after for e in events], [2, 4, 4, 8, 8])
+        self.assertEqual(events[2].nonzero_before, 4)
+        summary = profiler.summary()
+        self.assertEqual((summary["h"][0], summary["h"][2]), (3, 7))
+        self.assertEqual((summary["cx"][0], summary["cx"][2]), (2, 0))
+        self.assertEqual(profiler.peak.step, 3)
+        self.assertIn("densest state: 8 nonzero amplitudes after step 3 (h-3)", profiler.report())
+        # hooks don't change the result
+        ref = Simulator(4, qudit=2, circuit=sim.circuit, init_state={0: 1})
+        ref.run(optimize=False)
+        self.assertEqual(dict(sim.state), dict(ref.state))
+        # array states are costed by their arrays, 8 + 16 bytes per amplitude
+        sim = Simulator(12, qudit=2, circuit=[f"h-{i}" for i in range(12)], init_state={0: 1}, backend="array")
+        profiler = sim.add_hook(Profiler())
+        sim.run()
+        self.assertEqual(profiler.peak_memory, 24 * 2**12)
+
+    def test_qasm(self):
+        source = """OPENQASM 2.0;
+include "qelib1.inc";
+qreg a[2]; qreg b[2];
+creg c[4];
+// controlled phase from u1 and cx, with a parameter named like a Python keyword
+gate cu1(lambda) x, y {
+    u1(lambda/2) x; cx x, y;
+    u1(-lambda/2) y; cx x, y; u1(lambda/2) y;
+}
+h a;
+cu1(pi/2) a[0],
+    b[1];
+u3(pi^2/10, 0.5, -0.25) b[0];
+cx a, b;
+ccx a[0], a[1], b[0];
+barrier a;
+measure a -> c;
+"""
+        num_qubits, circuit = parse_qasm(source.splitlines(keepends=True))
+        self.assertEqual(num_qubits, 4)
+        self.assertEqual(circuit[:3], ["h-0", "h-1", f"phase-0;{cmath.pi/4!r}"])
+        sim = Simulator(num_qubits, qudit=2, circuit=circuit, init_state={0: 1})
+        sim.run()
+        ref = Simulator(4, qudit=2, init_state={0: 1})
+        ref.apply_h(0)
+        ref.apply_h(1)
+        ref.apply_controlled("phase", 0, 3, cmath.pi/2)
+        ref.apply_u(2, gates.phase(0.5) @ gates.Ry(cmath.pi**2/10) @ gates.phase(-0.25))
+        ref.apply_cx(0, 2)
+        ref.apply_cx(1, 3)
+        ref.apply_ccx(0, 1, 2)
+        for i in range(16):
+            self.assertAlmostEqual(sim.state[i], ref.state[i])
+        self.assertRaises(Exception, parse_qasm, ["qreg q[2];", "cx q[0], r[0];"])
+        self.assertRaises(Exception, parse_qasm, ["qreg q[2];", "h q[0]"])
+        # the second load comes from the cache, keyed by the file's hash
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "circuit.qasm")
+            with open(path, "w") as f:
+                f.write(source)
+            cache_dir = os.path.join(tmp, "cache")
+            self.assertEqual(load_qasm(path, cache_dir), (num_qubits, circuit))
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            self.assertEqual(load_qasm(path, cache_dir), (num_qubits, circuit))
+            with open(path, "a") as f:
+                f.write("x b[1];\n")
+            self.assertEqual(load_qasm(path, cache_dir)[1], circuit + ["x-3"])
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+    def test_expectation(self):
+        for backend in ("sparse", "array", "dense"):
+            sim = Simulator(3, qudit=2, circuit=["h-0", "cx-0,1", "Ry-2;0.5"], init_state={0: 1}, backend=backend)
+            sim.run()
+            # Bell pair on qubits 0 and 1, Ry(0.5)|0> on qubit 2
+            values = sim.expectation([(1, "Z0 Z1"), (2, "X0 X1"), (0.5, "Y0 Y1"), (1, "Z0"), (1, "X0"), (1, "X2"), (1, "Z2"), (3, "")], per_term=True)
+            expected = [1, 2, -0.5, 0, 0, cmath.sin(0.5), cmath.cos(0.5), 3]
+            for value,e in zip(values, expected):
+                self.assertAlmostEqual(value, e)
+            self.assertAlmostEqual(sim.expectation([(1, "Z0 Z1"), (2, "X0 X1 Z2")]), 1 + 2*cmath.cos(0.5))
+        self.assertRaises(Exception, sim.expectation, [(1, "X0 Z0")])
+        self.assertRaises(Exception, sim.expectation, [(1, "X3")])
+
+    def test_stabilizer(self):
+        circuit = ["h-0", "cx-0,1", "y-1", "h-2", "swap-2,3", "cx-3,0", "z-0", "h-1", "x-2"]
+        ref = Simulator(4, qudit=2, circuit=circuit, init_state={5: 1})
+        ref.run(stabilizer=False)
+        ref.remove_global_phase() # the tableau drops the global phase
+        sim = Simulator(4, qudit=2, circuit=circuit, init_state={5: 1})
+        sim.run(stabilizer=True)
+        self.assertIsInstance(sim.state, dict)
+        self.assertEqual(set(sim.state), set(ref.state))
+        for basis_state,amp in ref.state.items():
+            self.assertAlmostEqual(sim.state[basis_state], amp)
+        # 40-qubit GHZ state, then scrambled: too big to expand, but can be sampled
+        n = 40
+        sim = Simulator(n, qudit=2, circuit=["h-0"] + [f"cx-{i},{i+1}" for i in range(n-1)] + ["h-39", "swap-0,20"], init_state={0: 1})
+        sim.run(stabilizer="auto")
+        self.assertIsInstance(sim.state, dict)
+        self.assertEqual(len(sim.state), 4)
+        self.assertAlmostEqual(sim.state[2**40 - 1], -0.5)
+        sim = Simulator(n, qudit=2, circuit=[f"h-{i}" for i in range(30)] + [f"cx-{i},{i+30}" for i in range(10)], init_state={0: 1})
+        sim.run(stabilizer="auto")
+        self.assertIsInstance(sim.state, StabilizerState)
+        self.assertEqual(sim.state.rank, 30)
+        self.assertAlmostEqual(sim.state[1 + 2**30], 2**-15)
+        self.assertAlmostEqual(sim.state[1], 0)
+        counts = sim.sample(1000, qudits=[0, 30, 1], seed=1)
+        # qubit 30 is always equal to qubit 0
+        self.assertEqual(set(counts), {0, 3, 4, 7})
+        # probabilities come from the tableau too, without listing the 2**30 amplitudes
+        self.assertEqual(sim.probabilities([0, 30, 1]), {0: 0.25, 3: 0.25, 4: 0.25, 7: 0.25})
+        self.assertRaises(Exception, sim.probabilities, [0, 40])
+        circuit = ["h-0", "cx-0,1", "h-2", "cx-2,3", "cx-1,3"]
+        ref = Simulator(4, qudit=2, circuit=circuit, init_state={0: 1})
+        ref.run()
+        sim = Simulator(4, qudit=2, circuit=circuit, init_state={0: 1})
+        sim.run_stabilizer(max_expand=1)
+        self.assertIsInstance(sim.state, StabilizerState)
+        for qudits in ([3, 1], [2], None):
+            expected = ref.probabilities(qudits)
+            self.assertEqual(set(sim.probabilities(qudits)), set(expected))
+            for outcome,p in sim.probabilities(qudits).items():
+                self.assertAlmostEqual(p, expected[outcome])
+        self.assertRaises(Exception, Simulator(2, qudit=2, circuit=["h-0", "Rx-1;0.5"]).run, stabilizer=True)
+        # plain run() keeps the global phase, whatever the number of qubits
+        for n in (23, 24):
+            sim = Simulator(n, qudit=2, circuit=["y-0"], init_state={0: 1})
+            self.assertEqual(dict(sim.run()), {1: 1j})
+
+    def test_batch(self):
+        circuits = [["h-0", "cx-0,1"], ["h-0", "Ry-1;0.5", "cx-1,2"], ["x-2", "ccx-2,1,0"]]
+        jobs = [(3, 2, circuits[i % 3], {i % 8: 1}) for i in range(20)]
+        expected = []
+        for num_qudits,qudit,circuit,init_state in jobs:
+            sim = Simulator(num_qudits, qudit, circuit, init_state)
+            sim.run()
+            expected.append(dict(sim.state))
+        results = dict(run_batch(jobs, processes=2, chunk_size=3))
+        self.assertEqual(sorted(results), list(range(20)))
+        for i,state in results.items():
+            self.assertEqual(set(state), set(expected[i]))
+            for basis_state,amp in expected[i].items():
+                self.assertAlmostEqual(state[basis_state], amp)
+        async def collect():
+            return [result async for result in run_batch_async(jobs, processes=2, chunk_size=4, backend="dense")]
+        results = dict(asyncio.run(collect()))
+        self.assertEqual(sorted(results), list(range(20)))
+        for basis_state,amp in expected[5].items():
+            self.assertAlmostEqual(results[5][basis_state], amp)
+        self.assertRaises(Exception, list, run_batch([(2, 2, ["h-5"], {0: 1})], processes=1))
         
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -1,6 +1,12 @@
 import unittest
 import cmath
+import os
+import io
+import tempfile
+import numpy as np
 from simulator import Simulator
+from states import SparseState
+from sharded import ShardedSimulator
 from helper import *
 
 class TestQutritCircuits(unittest.TestCase):
@@ -39,5 +45,172 @@ class TestQutritCircuits(unittest.TestCase):
                 i = i - q1*3**1 + q1*3**9 # q9 never changed, so we just set q1=0, and q9=old_q1
             self.assertAlmostEqual(sim.state[i], 1/cmath.sqrt(3**5))
 
+    def test_apply_unitary(self):
+        # qutrit X (|j> --> |j+1 mod 3>) on two qutrits at once matches two single ones
+        shift = np.roll(np.eye(3), 1, axis=0)
+        sim = Simulator(3, qudit=3, init_state={0: 1, 5: 1})
+        sim.apply_unitary(np.kron(shift, shift), [0, 2])
+        self.assertAlmostEqual(sim.state[1 + 9], 1/cmath.sqrt(2))
+        self.assertAlmostEqual(sim.state[(5 + 1 - 3) + 9], 1/cmath.sqrt(2))
+        dense = Simulator(3, qudit=3, init_state={0: 1, 5: 1}, backend="dense")
+        dense.apply_unitary(shift, [0])
+        dense.apply_unitary(shift, [2])
+        self.assertEqual(dict(dense.state), dict(sim.state))
+        # any qudit dimension works, e.g. a 4-level Fourier transform
+        fourier = np.array([[1j**(j*k) for k in range(4)] for j in range(4)]) / 2
+        sim = Simulator(2, qudit=4, init_state={0: 1})
+        sim.apply_unitary(fourier, [1])
+        for i in range(4):
+            self.assertAlmostEqual(sim.state[4*i], 0.5)
+        self.assertRaises(Exception, sim.apply_unitary, fourier, [0, 1])
+
+    def test_controlled(self):
+        for backend in ["sparse", "array", "dense"]:
+            sim = Simulator(3, qudit=3, circuit=["h3-0"], init_state={0: 1}, backend=backend)
+            sim.run()
+            # h3 on qutrit 2 only when qutrit 0 is |2>
+            sim.apply_controlled("h3", 0, 2, control_values=[2])
+            self.assertAlmostEqual(sim.state[0], 1/cmath.sqrt(3))
+            self.assertAlmostEqual(sim.state[1], 1/cmath.sqrt(3))
+            for i in [2, 2 + 9, 2 + 18]:
+                self.assertAlmostEqual(sim.state[i], 1/3)
+
+    def test_sharded(self):
+        circuit = ["h3-0", "h3-1", "h3-2", "cswap3-0,1,3", "cswap3-4,2,1", "h3-4"]
+        sim = Simulator(5, qudit=3, circuit=circuit, init_state={0: 1})
+        sim.run()
+        sharded = ShardedSimulator(5, qudit=3, circuit=circuit, init_state={0: 1}, shard_qudits=1, backend="dense")
+        sharded.run()
+        for i in range(3**5):
+            self.assertAlmostEqual(sim.state[i], sharded.state[i])
+        # two sharded qutrits: each exchange pairs every worker with the two that differ in that digit
+        circuit += ["h3-3", "cswap3-3,4,0"]
+        sim = Simulator(5, qudit=3, circuit=circuit, init_state={0: 2j, 7: 1})
+        sim.run()
+        for backend in ["sparse", "array"]:
+            sharded = ShardedSimulator(5, qudit=3, circuit=circuit, init_state={0: 2j, 7: 1}, shard_qudits=2, backend=backend)
+            sharded.run()
+            self.assertGreater(sharded.exchanges, 1)
+            for i in range(3**5):
+                self.assertAlmostEqual(sim.state[i], sharded.state[i])
+
+    def test_bounded_history(self):
+        circuit = ["h3-0", "h3-1", "h3-2", "h3-3", "h3-4", "cswap3-0,1,9"]
+        full = Simulator(10, qudit=3, circuit=circuit, init_state={0: 1}, trackHistory=True, checkpoint_every=4)
+        last = Simulator(10, qudit=3, circuit=circuit, init_state={0: 1}, trackHistory=True, max_history=3)
+        full.run()
+        last.run()
+        self.assertEqual(len(full.history), 7)
+        self.assertEqual(len(last.history), 3)
+        for k in range(-3, 0):
+            self.assertEqual(full.history[k], last.history[k])
+        # print_sim labels the kept steps with the right gates
+        with open(os.devnull, "w") as f:
+            print_sim(last, f=f)
+
+    def test_memmap_backend(self):
+        circuit = ["h3-0", "h3-1", "h3-2", "h3-3", "h3-4", "cswap3-0,1,9"]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "state.bin")
+            # chunks of 3**4 amplitudes force the gates to run in chunks
+            sim = Simulator(10, qudit=3, circuit=circuit, init_state={0: 1}, backend="memmap", memmap_path=path, chunk_size=3**4)
+            sim.run()
+            self.assertEqual(len(list(sim.chunk_groups(sim.compile()))), 2)
+            for i in range(3**5):
+                if (i % 3) == 1:
+                    q1 = (i//3**1)%3
+                    i = i - q1*3**1 + q1*3**9
+                self.assertAlmostEqual(sim.state[i], 1/cmath.sqrt(3**5))
+            del sim
+            # pick up the saved state and undo the swap
+            resumed = Simulator(10, qudit=3, circuit=["cswap3-0,1,9"], backend="memmap", memmap_path=path, resume=True)
+            resumed.run()
+            for i in range(3**5):
+                self.assertAlmostEqual(resumed.state[i], 1/cmath.sqrt(3**5))
+            del resumed
+
+    def test_export(self):
+        sim = Simulator(3, qudit=3, circuit=["h3-0", "h3-2", "cswap3-0,1,2"], init_state={0: 1}, trackHistory=True)
+        sim.run()
+        self.assertEqual(basis_labels(np.array([0, 5, 26]), 3, 3), ["000", "012", "222"])
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "circ1.npz")
+            export_npz(sim, path)
+            with np.load(path) as saved:
+                self.assertEqual(saved["indices_3"].tolist(), [0, 1, 2, 4, 7, 9, 11, 18, 20])
+                for amp in saved["amps_3"]:
+                    self.assertAlmostEqual(amp, 1/3)
+        out = io.StringIO()
+        export_csv(sim, out)
+        rows = out.getvalue().splitlines()
+        self.assertEqual(len(rows), 1 + 1 + 3 + 9 + 9)
+        self.assertEqual(rows[-1].split(",")[:2], ["3", ""])
+
+    def test_sampling(self):
+        sim = Simulator(3, qudit=3, circuit=["h3-0", "h3-2", "cswap3-0,1,2"], init_state={0: 1})
+        sim.run()
+        # qutrit 1 is only nonzero after the swap, in 2 of the 9 equally likely states
+        probs = sim.probabilities([1])
+        self.assertAlmostEqual(probs[0], 7/9)
+        self.assertAlmostEqual(probs[1], 1/9)
+        counts = sim.sample(90000, qudits=[1, 2], seed=1)
+        self.assertEqual(sum(counts.values()), 90000)
+        # qutrits 1,2 = |11> would be outcome 1 + 3*1 = 4, which never happens
+        self.assertNotIn(4, counts)
+        self.assertAlmostEqual(counts[1] / 90000, 1/9, places=2)
+        for qudits in ([3], [-1]):
+            self.assertRaises(Exception, sim.probabilities, qudits)
+            self.assertRaises(Exception, sim.sample, 10, qudits)
+
+    def test_compile(self):
+        sim = Simulator(2, qudit=3, circuit=["h3-0", "h3-1", "h3-0", "h3-0", "h3-0"], init_state={0: 1})
+        # h3 applied 4 times is the identity
+        self.assertEqual(len(sim.compile()), 1)
+        sim.run()
+        for i in [0, 3, 6]:
+            self.assertAlmostEqual(sim.state[i], 1/cmath.sqrt(3))
+        # qubit gates raise even when they would cancel out
+        self.assertRaises(Exception, Simulator(2, qudit=3, circuit=["h-0", "h-0"]).run)
+
+    def test_auto_backend(self):
+        sim = Simulator(5, qudit=3, circuit=["h3-0", "h3-1", "h3-2", "cswap3-0,1,3", "cswap3-4,2,1"],
+                        init_state={0: 1}, trackHistory=True, backend="auto", dense_threshold=0.1)
+        sim.run()
+        # 3 and 9 nonzero states stay sparse, 27 out of 243 goes over the threshold
+        self.assertIsInstance(sim.history[2], dict)
+        self.assertNotIsInstance(sim.history[3], dict)
+        self.assertTrue(sim.dense)
+        self.assertEqual(sim.history[-2], sim.history[-1])
+
+    def test_expectation(self):
+        omega = cmath.exp(2j*cmath.pi/3)
+        # h3|0> on qutrit 0 is the +1 eigenstate of the shift X, qutrit 1 is |1>
+        sim = Simulator(2, qudit=3, circuit=["h3-0"], init_state={3: 1})
+        sim.run()
+        values = sim.expectation([(1, "X0"), (1, "Z0"), (1, "Z1"), (1, "X1"), (1, "X0 Z1^2"), (1, "X0^2 Z0")], per_term=True)
+        for value,e in zip(values, [1, 0, omega, 0, omega**2, 0]):
+            self.assertAlmostEqual(value, e)
+        self.assertRaises(Exception, sim.expectation, [(1, "Y0")])
+        # operators multiply in the order of the string: ZX = omega XZ
+        sim = Simulator(1, qudit=3, init_state={0: 1, 1: 1})
+        self.assertAlmostEqual(sim.expectation([(1, "Z0 X0")]), omega/2)
+        self.assertAlmostEqual(sim.expectation([(1, "X0 Z0")]), 1/2)
+
+    def test_array_backend(self):
+        circuit = ["h3-0", "h3-1", "h3-2", "cswap3-0,1,3", "cswap3-4,2,1", "h3-4", "h3-4"]
+        ref = Simulator(5, qudit=3, circuit=circuit, init_state={0: 1}, trackHistory=True, checkpoint_every=3)
+        ref.run()
+        sim = Simulator(5, qudit=3, circuit=circuit, init_state={0: 1}, trackHistory=True, checkpoint_every=3, backend="array")
+        sim.run()
+        self.assertIsInstance(sim.state, SparseState)
+        self.assertEqual(len(sim.history), len(ref.history))
+        for t in range(len(ref.history)):
+            self.assertEqual(set(sim.history[t]), set(ref.history[t]))
+            for basis_state,amp in ref.history[t].items():
+                self.assertAlmostEqual(sim.history[t][basis_state], amp)
+        # h3 twice is a permutation (|1> <--> |2>), the amplitudes that cancel out are removed
+        self.assertEqual(len(sim.state), len(sim.history[5]))
+        self.assertEqual(sim.probabilities([1]), ref.probabilities([1]))
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file